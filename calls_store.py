@@ -0,0 +1,98 @@
+import argparse
+import shutil
+import sys
+from pathlib import Path
+from typing import List, Optional, Iterable, Union
+import datetime as dt
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+CATEGORICAL_COLUMNS = ['substation', 'call_reason', 'call_type']
+PARTITIONING = ds.partitioning(pa.schema([('month', pa.string()), ('substation', pa.string())]), flavor='hive')
+
+
+def read_processed(path: Path) -> pd.DataFrame:
+    # data_processed.csv или папка с кусками из parse_data.py --stream/--incremental
+    # все колонки - строки, пустые значения - '' (а не 'nan'/'None'), как бы ни выглядел отдельный кусок
+    if path.is_dir():
+        parquet_files = sorted(path.glob('*-*.parquet'))
+        csv_files = sorted(path.glob('*-*.csv'))
+        if csv_files and not parquet_files:
+            # куски читаем так же, как целый .csv: типы, выведенные pyarrow по первому куску
+            # (call_number из одних цифр -> int64), на следующих кусках ломаются
+            return pd.concat([pd.read_csv(file, dtype=str, keep_default_na=False) for file in csv_files],
+                             ignore_index=True)
+        table = ds.dataset([str(file) for file in parquet_files], format='parquet').to_table()
+        return table.to_pandas().fillna('').astype(str)
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def make_typed(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    df['call_date'] = pd.to_datetime(df['call_date'], errors='coerce').dt.normalize()
+    # 'HH:MM:SS' -> полное время вызова; кривые значения (вроде '1970-01-01 ...') становятся NaT
+    df['call_time'] = df['call_date'] + pd.to_timedelta(df['call_time'], errors='coerce')
+    for col in CATEGORICAL_COLUMNS:
+        df[col] = df[col].astype('category')
+    df['month'] = df['call_date'].dt.strftime('%Y-%m')
+    return df
+
+
+def write_calls(df: pd.DataFrame, root: Path):
+    # пишем в соседнюю папку и подменяем, чтобы не оставались партиции от прошлой версии
+    tmp_root = root.with_name(root.name + '.tmp')
+    shutil.rmtree(tmp_root, ignore_errors=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    ds.write_dataset(table, str(tmp_root), format='parquet', partitioning=PARTITIONING,
+                     basename_template='part-{i}.parquet')
+    shutil.rmtree(root, ignore_errors=True)
+    tmp_root.rename(root)
+
+
+def build_store(processed_path: Path, root: Path):
+    write_calls(make_typed(read_processed(processed_path)), root)
+
+
+def read_calls(root: Union[str, Path], columns: Optional[List[str]] = None,
+               substations: Optional[Iterable[str]] = None,
+               date_from: Optional[dt.datetime] = None, date_to: Optional[dt.datetime] = None) -> pd.DataFrame:
+    # фильтры по подстанции и месяцу отсекают целые партиции, по call_date - строки внутри них
+    dataset = ds.dataset(str(root), format='parquet', partitioning=PARTITIONING)
+    filters = []
+    if substations is not None:
+        filters.append(ds.field('substation').isin(list(substations)))
+    if date_from is not None:
+        date_from = pd.Timestamp(date_from)
+        filters.append(ds.field('month') >= date_from.strftime('%Y-%m'))
+        filters.append(ds.field('call_date') >= date_from)
+    if date_to is not None:
+        date_to = pd.Timestamp(date_to)
+        filters.append(ds.field('month') <= date_to.strftime('%Y-%m'))
+        filters.append(ds.field('call_date') <= date_to)
+    expression = None
+    for f in filters:
+        expression = f if expression is None else expression & f
+    if columns is None:
+        columns = [name for name in dataset.schema.names if name != 'month']
+
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and df[col].dtype != 'category':
+            df[col] = df[col].astype('category')
+    return df
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Колоночное хранилище вызовов, партиции по месяцу и подстанции')
+    parser.add_argument('--input', type=Path, default=Path('data_processed.csv'),
+                        help='data_processed.csv или папка с кусками parse_data.py')
+    parser.add_argument('--output', type=Path, default=Path('calls_store'))
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    print(f': Building {args.output} from {args.input}')
+    build_store(args.input, args.output)
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype
+
+
+def _present(col: pd.Series) -> pd.Series:
+    return col.notna() & (col.astype(str) != '')
+
+
+def preprocess_calls(df: pd.DataFrame) -> pd.DataFrame:
+    # то же, что preproc из train-best-notebook.ipynb, но без цикла по строкам:
+    # выкидываем вызовы без времени/подстанции/госпитализации и округляем время вызова до часа
+    df = df[_present(df['call_time']) & _present(df['substation']) & _present(df['hospitalized_to'])].copy()
+    if is_datetime64_any_dtype(df['call_time']):
+        # хранилище calls_store.py - call_time уже полное время вызова
+        date_time = df['call_time'].dt.floor('H')
+    else:
+        hours = df['call_time'].astype(str).str[:-5]
+        date_time = (df['call_date'].astype(str) + ' ' + hours + '00:00').where(~hours.str.contains('1970'))
+        date_time = pd.to_datetime(date_time)
+    df['call_number'] = df['call_number'].astype(str).str.split('(').str[0]
+    df = df.drop(columns=['call_time', 'call_date'])
+    df['date_time'] = date_time
+    return df[df['date_time'].notna()]
+
+
+def hourly_counts(df: pd.DataFrame) -> pd.DataFrame:
+    # то же, что preproc2: матрица "час x подстанция" с числом вызовов, часы - от первого до последнего вызова,
+    # подстанции - в порядке первого появления. Считаем одним bincount по плоскому индексу час * n + подстанция
+    substations = list(pd.unique(np.asarray(df['substation'], dtype=object)))
+    hours = df['date_time'].to_numpy().astype('datetime64[h]')
+    if len(hours) == 0:
+        return pd.DataFrame(columns=['date'])
+    start = hours.min()
+    hour_idx = (hours - start).astype(np.int64)
+    n_hours = int(hour_idx.max()) + 1
+    sub_idx = pd.Categorical(np.asarray(df['substation'], dtype=object), categories=substations).codes.astype(np.int64)
+
+    counts = np.bincount(hour_idx * len(substations) + sub_idx, minlength=n_hours * len(substations))
+    times = pd.DataFrame(counts.reshape(n_hours, len(substations)), columns=substations)
+    times.insert(0, 'date', pd.date_range(pd.Timestamp(start), periods=n_hours, freq='H'))
+    return times
+
+
+def update_hourly_counts(times: pd.DataFrame, new_calls: pd.DataFrame) -> pd.DataFrame:
+    # добавляет к уже посчитанной матрице новые (предобработанные) вызовы:
+    # диапазон часов расширяется, новые подстанции дописываются справа
+    new_times = hourly_counts(new_calls)
+    if len(new_times) == 0:
+        return times.copy()
+    if len(times) == 0:
+        return new_times
+
+    substations = list(times.columns[1:]) + [x for x in new_times.columns[1:] if x not in times.columns]
+    start = min(times['date'].iloc[0], new_times['date'].iloc[0])
+    end = max(times['date'].iloc[-1], new_times['date'].iloc[-1])
+    dates = pd.date_range(start, end, freq='H')
+    counts = np.zeros((len(dates), len(substations)), dtype=np.int64)
+    sub_pos = {x: i for i, x in enumerate(substations)}
+    for part in (times, new_times):
+        offset = (part['date'].iloc[0] - start) // pd.Timedelta(hours=1)
+        cols = [sub_pos[x] for x in part.columns[1:]]
+        counts[offset:offset + len(part), cols] += part[part.columns[1:]].to_numpy(dtype=np.int64)
+
+    out = pd.DataFrame(counts, columns=substations)
+    out.insert(0, 'date', dates)
+    return out
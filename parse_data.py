@@ -1,30 +1,46 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Iterator, Any, List, Dict
+from typing import Iterator, Iterable, Any, List, Dict, Tuple
 import datetime as dt
 
 import pandas as pd
 import pyexcel as pex
 from tqdm import tqdm
 
+from calls_store import build_store
 
-def parse_sheet(sheet: List[List[Any]]) -> List[Dict[str, Any]]:
-    sheet_bar = tqdm(sheet)
+COLUMNS = ['call_date', 'call_number', 'patient_age', 'call_initiator', 'patient_address', 'call_reason',
+           'call_order', 'call_type', 'patient_diagnosis', 'call_result', 'hospitalized_to', 'substation',
+           'call_time', 'arrival_time']
+ROW_WIDTH = 20  # parse_block смотрит максимум в 20-ю колонку
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 2  # с 2 - файлы по путям относительно data_dir
+
+
+def iter_sheet_blocks(rows: Iterable[List[Any]]) -> Iterator[Dict[str, Any]]:
+    sheet_bar = tqdm(rows)
     sheet_iter = iter(sheet_bar)
 
-    report_date = next(sheet_iter)  # skip
-    if next(sheet_iter)[0] != 'Журнал Активных вызовов':
-        raise ValueError('Invalid sheet format :/')
-    next(sheet_iter)  # skip
+    try:
+        report_date = next(sheet_iter)  # skip
+        if next(sheet_iter)[0] != 'Журнал Активных вызовов':
+            raise ValueError('Invalid sheet format :/')
+        next(sheet_iter)  # skip
+    except StopIteration:
+        return
 
-    blocks = []
     try:
         skipped_rows = 0
         while True:
             sheet_bar.refresh()
             try:
-                block = parse_block(sheet_iter)
-                blocks.append(block)
+                yield parse_block(sheet_iter)
             except ValueError:
                 skipped_rows += 1
                 sheet_bar.set_postfix({'skipped_rows': skipped_rows})
@@ -32,7 +48,10 @@ def parse_sheet(sheet: List[List[Any]]) -> List[Dict[str, Any]]:
     except StopIteration:
         pass
     sheet_bar.refresh()
-    return blocks
+
+
+def parse_sheet(sheet: List[List[Any]]) -> List[Dict[str, Any]]:
+    return list(iter_sheet_blocks(sheet))
 
 
 def parse_file(file: Path):
@@ -44,6 +63,64 @@ def parse_file(file: Path):
     return blocks
 
 
+def pad_rows(rows: Iterable[List[Any]]) -> Iterator[List[Any]]:
+    # при потоковом чтении хвостовые пустые ячейки обрезаны, get_book_dict же дополняет строки ''
+    for row in rows:
+        yield row + [''] * (ROW_WIDTH - len(row)) if len(row) < ROW_WIDTH else row
+
+
+def iter_file_blocks(file: Path) -> Iterator[Dict[str, Any]]:
+    # листы читаются построчно, книга целиком в памяти не держится
+    book = pex.iget_book(file_name=str(file))
+    try:
+        for sheet_name, rows in book.to_dict().items():
+            yield from iter_sheet_blocks(pad_rows(rows))
+    finally:
+        pex.free_resources()
+
+
+def iter_chunks(blocks: Iterable[Dict[str, Any]], chunk_size: int) -> Iterator[pd.DataFrame]:
+    chunk = []
+    for block in blocks:
+        chunk.append(block)
+        if len(chunk) >= chunk_size:
+            yield pd.DataFrame(chunk, columns=COLUMNS)
+            chunk = []
+    if chunk:
+        yield pd.DataFrame(chunk, columns=COLUMNS)
+
+
+def part_prefix(file: Path) -> str:
+    return hashlib.sha1(str(file).encode('utf-8')).hexdigest()[:16]
+
+
+def write_chunk(chunk: pd.DataFrame, part: Path):
+    if part.suffix == '.parquet':
+        chunk.astype('string').to_parquet(part, index=False)
+    else:
+        chunk.to_csv(part, index=False)
+
+
+def write_file_parts(file: Path, parts_dir: Path, chunk_size: int, fmt: str) -> List[Path]:
+    print(f':: Parsing file {file}')
+    parts = []
+    for i, chunk in enumerate(iter_chunks(iter_file_blocks(file), chunk_size)):
+        part = parts_dir / f'{part_prefix(file)}-{i:05d}.{fmt}'
+        write_chunk(chunk, part)
+        parts.append(part)
+    return parts
+
+
+def concat_csv_parts(parts: Iterable[Path], out_file: Path, append: bool = False):
+    with open(out_file, 'ab' if append else 'wb') as out:
+        if not append:
+            out.write((','.join(COLUMNS) + '\n').encode('utf-8'))
+        for part in parts:
+            with open(part, 'rb') as f:
+                f.readline()  # header
+                shutil.copyfileobj(f, out)
+
+
 def raise_for_prefill(value: Any, prefill_text: str):
     if not isinstance(value, str):
         raise ValueError('Prefill is not a string!')
@@ -102,14 +179,195 @@ def parse_block(sheet_iter: Iterator[List[Any]]):
     return out_dict
 
 
+def parse_files(files: List[Path], parts_dir: Path, chunk_size: int, fmt: str, workers: int) -> List[List[Path]]:
+    if not files:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(write_file_parts, files, [parts_dir] * len(files), [chunk_size] * len(files),
+                             [fmt] * len(files)))
+
+
+def parse_streaming(files: List[Path], data_dir: Path, parts_dir: Path, chunk_size: int, fmt: str,
+                    workers: int) -> List[Path]:
+    # все файлы заново, но manifest пишем и здесь - следующему --incremental не придется разбирать все еще раз
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    for old_part in parts_dir.glob('*-*.*'):
+        old_part.unlink()
+    (parts_dir / MANIFEST_NAME).unlink(missing_ok=True)
+    file_parts = parse_files(files, parts_dir, chunk_size, fmt, workers)
+    entries = {file_key(file, data_dir): file_entry(file, parts, fmt) for file, parts in zip(files, file_parts)}
+    save_manifest(parts_dir, {'version': MANIFEST_VERSION, 'files': entries, 'output': None})
+    return [part for parts in file_parts for part in parts]
+
+
+def file_key(file: Path, data_dir: Path) -> str:
+    # ключ в manifest - путь относительно data_dir: одинаковый, как бы data_dir ни передали
+    # (data из корня репозитория или абсолютный путь из ingest_queue.py)
+    return file.resolve().relative_to(data_dir.resolve()).as_posix()
+
+
+def legacy_key(key: str, data_dir: Path) -> str:
+    # в manifest до версии 2 ключ - str(file), то есть путь от текущей папки или абсолютный
+    try:
+        return file_key(Path(key), data_dir)
+    except ValueError:
+        return key
+
+
+def file_hash(file: Path) -> str:
+    sha = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for buf in iter(lambda: f.read(1 << 20), b''):
+            sha.update(buf)
+    return sha.hexdigest()
+
+
+def file_entry(file: Path, parts: List[Path], fmt: str) -> Dict[str, Any]:
+    stat = file.stat()
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sha1': file_hash(file),
+        'format': fmt,
+        'parts': [part.name for part in parts]
+    }
+
+
+def output_entry(output: Path) -> Dict[str, Any]:
+    stat = output.stat()
+    return {'path': str(output.resolve()), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def load_manifest(parts_dir: Path) -> Dict[str, Any]:
+    # files - разобранные журналы и их куски, output - каким был .csv, собранный из этих кусков
+    manifest_path = parts_dir / MANIFEST_NAME
+    if not manifest_path.is_file():
+        return {'version': MANIFEST_VERSION, 'files': {}, 'output': None}
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    # manifest прежнего вида - только файлы; про .csv ничего не известно, его соберем заново
+    return manifest if 'files' in manifest else {'files': manifest, 'output': None}
+
+
+def save_manifest(parts_dir: Path, manifest: Dict[str, Any]):
+    tmp_path = parts_dir / (MANIFEST_NAME + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, parts_dir / MANIFEST_NAME)
+
+
+def remove_file_parts(parts_dir: Path, entry: Dict[str, Any]):
+    for part in entry['parts']:
+        (parts_dir / part).unlink(missing_ok=True)
+
+
+def is_unchanged(file: Path, entry: Dict[str, Any], parts_dir: Path, fmt: str) -> bool:
+    if entry is None or entry['format'] != fmt or not all((parts_dir / part).is_file() for part in entry['parts']):
+        return False
+    stat = file.stat()
+    if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+        return True
+    if entry['size'] != stat.st_size or entry['sha1'] != file_hash(file):
+        return False
+    entry['mtime'] = stat.st_mtime_ns  # файл тронули, но содержимое то же
+    return True
+
+
+def ingest_incremental(files: List[Path], data_dir: Path, parts_dir: Path, chunk_size: int, fmt: str,
+                       workers: int) -> Tuple[List[Path], List[Path], bool]:
+    # разбираем только новые и изменившиеся файлы, куски остальных берем из прошлых запусков.
+    # возвращаем все куски в порядке файлов, только что записанные куски и флаг того,
+    # что из датасета что-то удалили или заменили (тогда просто дописать .csv нельзя)
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    full_manifest = load_manifest(parts_dir)
+    if full_manifest.get('version') != MANIFEST_VERSION:
+        full_manifest['files'] = {legacy_key(key, data_dir): entry for key, entry in full_manifest['files'].items()}
+        full_manifest['version'] = MANIFEST_VERSION
+    manifest = full_manifest['files']
+    keys = {file: file_key(file, data_dir) for file in files}
+
+    replaced = False
+    for key in [key for key in manifest if key not in keys.values()]:
+        print(f':: File {key} is gone, dropping its rows')
+        remove_file_parts(parts_dir, manifest.pop(key))
+        replaced = True
+
+    to_parse = [file for file in files if not is_unchanged(file, manifest.get(keys[file]), parts_dir, fmt)]
+    print(f': {len(files) - len(to_parse)} files unchanged, {len(to_parse)} to parse')
+    for file in to_parse:
+        if keys[file] in manifest:
+            remove_file_parts(parts_dir, manifest.pop(keys[file]))
+            replaced = True
+
+    new_parts = parse_files(to_parse, parts_dir, chunk_size, fmt, workers)
+    for file, parts in zip(to_parse, new_parts):
+        manifest[keys[file]] = file_entry(file, parts, fmt)
+    save_manifest(parts_dir, full_manifest)
+
+    all_parts = [parts_dir / part for file in files for part in manifest[keys[file]]['parts']]
+    return all_parts, [part for parts in new_parts for part in parts], replaced
+
+
+def write_output(parts_dir: Path, output: Path, parts: List[Path], new_parts: List[Path], replaced: bool):
+    # дописывать можно, только если .csv - ровно тот, что в прошлый раз собран из кусков по manifest.
+    # иначе (manifest нет, .csv записан обычным режимом, тронут руками) собираем его заново
+    manifest = load_manifest(parts_dir)
+    if replaced or not output.is_file() or manifest['output'] != output_entry(output):
+        print(f': Writing {output}')
+        concat_csv_parts(parts, output)
+    elif new_parts:
+        print(f': Appending {len(new_parts)} chunks to {output}')
+        concat_csv_parts(new_parts, output, append=True)
+    manifest['output'] = output_entry(output)
+    save_manifest(parts_dir, manifest)
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Парсинг журналов вызовов (.xls) в единый датасет')
+    parser.add_argument('--data-dir', type=Path, default=Path('data'))
+    parser.add_argument('--output', type=Path, default=Path('data_processed.csv'))
+    parser.add_argument('--stream', action='store_true',
+                        help='построчное чтение и параллельный разбор файлов с записью по кускам')
+    parser.add_argument('--incremental', action='store_true',
+                        help='как --stream, но разбирать только новые и изменившиеся файлы (см. manifest.json)')
+    parser.add_argument('--parts-dir', type=Path, default=Path('data_processed'),
+                        help='куда складывать куски в режимах --stream и --incremental')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--chunk-size', type=int, default=50_000, help='блоков в одном куске')
+    parser.add_argument('--workers', type=int, default=None, help='по умолчанию - число ядер')
+    parser.add_argument('--store', type=Path, default=None,
+                        help='дополнительно собрать колоночное хранилище вызовов (см. calls_store.py)')
+    return parser.parse_args(argv)
+
+
 if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
 
     print(': Parsing files')
-    files = list(Path('data').rglob('*.xls'))
-    blocks = []
-    for file in files:
-        blocks.extend(parse_file(file))
+    files = sorted(args.data_dir.rglob('*.xls'))
+
+    if args.incremental:
+        parts, new_parts, replaced = ingest_incremental(files, args.data_dir, args.parts_dir, args.chunk_size,
+                                                        args.format, args.workers)
+        if args.format == 'csv':
+            write_output(args.parts_dir, args.output, parts, new_parts, replaced)
+        else:
+            print(f': Parquet dataset is updated in {args.parts_dir}')
+    elif args.stream:
+        parts = parse_streaming(files, args.data_dir, args.parts_dir, args.chunk_size, args.format, args.workers)
+        if args.format == 'csv':
+            write_output(args.parts_dir, args.output, parts, parts, True)
+        else:
+            print(f': Parquet dataset is written to {args.parts_dir}')
+    else:
+        blocks = []
+        for file in files:
+            blocks.extend(parse_file(file))
+
+        print(': Writing .csv')
+        blocks_df = pd.DataFrame(blocks)
+        blocks_df.to_csv(args.output, index=False)
 
-    print(': Writing .csv')
-    blocks_df = pd.DataFrame(blocks)
-    blocks_df.to_csv('data_processed.csv', index=False)
+    if args.store is not None:
+        print(f': Building calls store {args.store}')
+        build_store(args.parts_dir if (args.stream or args.incremental) else args.output, args.store)
@@ -0,0 +1,127 @@
+import hashlib
+import io
+import json
+from typing import Iterator, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from flask import Blueprint, Response, jsonify, request
+
+from rollups import build_rollups
+from snapshot import FactoryHolder
+
+API_CHUNK_ROWS = 1000  # строк прогноза в одном куске ответа
+API_MAX_HOURS = 366 * 24  # больше за один запрос не отдаем, чтобы не занимать воркер надолго
+API_MAX_COMPUTED_HOURS = 7 * 24  # часов вне снапшота, которые досчитываются прямо в запросе (укладываемся в таймаут)
+API_LEVELS = ['hour', 'day']
+API_FORMATS = {'json': 'application/json', 'arrow': 'application/vnd.apache.arrow.stream'}
+
+
+class ApiError(ValueError):
+    pass
+
+
+def _parse_date(value: str, name: str) -> pd.Timestamp:
+    try:
+        date = pd.Timestamp(value)
+    except ValueError:
+        raise ApiError(f'{name}: bad date {value!r}')
+    if date is pd.NaT:
+        raise ApiError(f'{name}: bad date {value!r}')
+    if date.tz is not None:
+        # прогноз - в местном времени без зоны, пересчитывать из чужой зоны не беремся
+        raise ApiError(f'{name}: expected local time without timezone, got {value!r}')
+    return date.floor('H')
+
+
+def _json_chunks(index: pd.DatetimeIndex, calls: np.ndarray, names: List[str], level: str, version: str
+                 ) -> Iterator[str]:
+    header = {'version': version, 'level': level, 'substations': names}
+    yield json.dumps(header, ensure_ascii=False)[:-1] + ', "rows": ['
+    times = index.strftime('%Y-%m-%dT%H:%M:%S')
+    for start in range(0, len(index), API_CHUNK_ROWS):
+        rows = [[time, *values] for time, values in zip(times[start:start + API_CHUNK_ROWS],
+                                                         calls[start:start + API_CHUNK_ROWS].tolist())]
+        yield (', ' if start else '') + json.dumps(rows)[1:-1]
+    yield ']}'
+
+
+def _drain(sink: io.BytesIO) -> bytes:
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def _arrow_chunks(index: pd.DatetimeIndex, calls: np.ndarray, names: List[str]) -> Iterator[bytes]:
+    # Arrow IPC stream: схема, затем по record batch на кусок - клиент читает через pyarrow.ipc.open_stream
+    schema = pa.schema([('date_time', pa.timestamp('ns'))] + [(name, pa.float64()) for name in names])
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for start in range(0, len(index), API_CHUNK_ROWS):
+            end = start + API_CHUNK_ROWS
+            columns = [pa.array(index[start:end].to_numpy())] + \
+                      [pa.array(np.ascontiguousarray(calls[start:end, j])) for j in range(len(names))]
+            writer.write_batch(pa.record_batch(columns, schema=schema))
+            yield _drain(sink)
+    yield _drain(sink)
+
+
+# пакетная выгрузка прогноза: GET /api/forecast?from=2022-06-01&to=2022-06-30&level=day&substations=a,b&format=arrow
+# ответ отдается кусками; ETag - от версии снапшота и параметров, так что повторный запрос с If-None-Match - 304
+def create_api(factories: FactoryHolder) -> Blueprint:
+    api = Blueprint('api', __name__)
+
+    @api.errorhandler(ApiError)
+    def bad_request(e: ApiError):
+        return jsonify({'error': str(e)}), 400
+
+    @api.route('/forecast')
+    def forecast():
+        graph_factory = factories.current
+        args = request.args
+        date_from = _parse_date(args.get('from', str(graph_factory.infer_from)), 'from')
+        date_to = _parse_date(args.get('to', str(graph_factory.infer_to)), 'to')
+        level = args.get('level', 'hour')
+        fmt = args.get('format', 'json')
+        names = list(graph_factory.substation_names)
+        substations = [x for x in args.get('substations', '').split(',') if x] or names
+        if level not in API_LEVELS:
+            raise ApiError(f'level: expected one of {API_LEVELS}')
+        if level == 'day':
+            # только целые дни, чтобы крайние не оказались неполными суммами
+            date_from, date_to = date_from.normalize(), date_to.normalize() + pd.Timedelta(hours=23)
+        if fmt not in API_FORMATS:
+            raise ApiError(f'format: expected one of {list(API_FORMATS)}')
+        if date_to < date_from:
+            raise ApiError('to is earlier than from')
+        if (date_to - date_from) // pd.Timedelta(hours=1) + 1 > API_MAX_HOURS:
+            raise ApiError(f'at most {API_MAX_HOURS} hours per request')
+        unknown = [x for x in substations if x not in names]
+        if unknown:
+            raise ApiError(f'unknown substations: {unknown}')
+        if graph_factory.missing_hours(date_from, date_to) > API_MAX_COMPUTED_HOURS:
+            raise ApiError(f'at most {API_MAX_COMPUTED_HOURS} hours outside of the forecast range '
+                           f'{graph_factory.infer_from} - {graph_factory.infer_to} per request')
+
+        query = [graph_factory.version, level, fmt, date_from.isoformat(), date_to.isoformat(), *substations]
+        etag = hashlib.sha1('|'.join(query).encode('utf-8')).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        index, calls = graph_factory.get_hourly_forecast(date_from, date_to)
+        if level == 'day':
+            day = build_rollups(index, calls, np.array(names, dtype=object))['day']
+            index, calls = day.index, day.calls
+        calls = calls[:, [names.index(x) for x in substations]]
+
+        chunks = _arrow_chunks(index, calls, substations) if fmt == 'arrow' else \
+            _json_chunks(index, calls, substations, level, graph_factory.version)
+        response = Response(chunks, mimetype=API_FORMATS[fmt])
+        response.set_etag(etag)
+        return response
+
+    return api
@@ -1,3 +1,4 @@
+import base64
 from datetime import datetime as dt
 
 import dash
@@ -5,17 +6,68 @@ import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
 import pandas as pd
-import shap
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 
 import utils.dash_reusable_components as drc
+from api import create_api
+from figure_cache import FigureCache
 from graph_factory import GraphFactory
+from ingest_queue import IngestQueue
 from plotly_style import apply_plotly_style
+from snapshot import FactoryHolder, make_graph_factory
+
+FIGURE_WARMUP_DAYS = 7  # сколько первых дней прогноза отрисовать заранее (0 - не прогревать)
+CLIENTSIDE_FIGURES = True  # карту и распределение за день рисует браузер (assets/figures.js), сервер отдает только блок дня
 
 apply_plotly_style()
 
-graph_factory = GraphFactory('../fixed_substation.json', '../models', dt(2022, 5, 25), dt(2023, 5, 25), '../caches.pkl')
-graph_factory.load()
+# снапшот и модели для SHAP грузим до форка, чтобы воркеры делили одну копию; новые снапшоты
+# (python snapshot.py) воркеры подхватывают сами, между запросами
+factories = FactoryHolder(make_graph_factory)
+
+figure_cache = FigureCache('../figures.sqlite')
+# журналы разбирает отдельный процесс: python ingest_queue.py (см. start.sh); manifest - чтобы сразу
+# отвечать на повторную загрузку уже разобранного журнала
+ingest_queue = IngestQueue('../spool', '../data_processed/manifest.json')
+
+
+def densmap_figure(graph_factory: GraphFactory, date: pd.Timestamp, hour: int, show_hour: bool) -> dict:
+    key = f"{graph_factory.version}/densmap/{date:%Y-%m-%d}/{hour if show_hour else 'day'}"
+    return figure_cache.get_or_create(key, lambda: graph_factory.get_densmap_figure(date, hour, show_hour))
+
+
+def histogram_figure(graph_factory: GraphFactory, date: pd.Timestamp) -> dict:
+    key = f"{graph_factory.version}/histogram/{date:%Y-%m-%d}"
+    return figure_cache.get_or_create(key, lambda: graph_factory.create_substation_daily_figure(date))
+
+
+def total_figure(graph_factory: GraphFactory) -> dict:
+    return figure_cache.get_or_create(f"{graph_factory.version}/total", graph_factory.create_total_figure)
+
+
+def densmap_template(graph_factory: GraphFactory) -> dict:
+    figure = figure_cache.get_or_create(f"{graph_factory.version}/densmap-template",
+                                        graph_factory.create_densmap_template)
+    return {'version': graph_factory.version, 'figure': figure}
+
+
+def histogram_template(graph_factory: GraphFactory) -> dict:
+    figure = figure_cache.get_or_create(f"{graph_factory.version}/histogram-template",
+                                        graph_factory.create_histogram_template)
+    return {'version': graph_factory.version, 'figure': figure, 'order': graph_factory.rollups['hour'].order.tolist()}
+
+
+def warm_up_figures(graph_factory: GraphFactory, days: int):
+    if CLIENTSIDE_FIGURES:
+        return
+    for date in pd.date_range(graph_factory.infer_from, periods=days, freq='D'):
+        densmap_figure(graph_factory, date, 0, False)
+        for hour in range(24):
+            densmap_figure(graph_factory, date, hour, True)
+        histogram_figure(graph_factory, date)
+
+
+warm_up_figures(factories.current, FIGURE_WARMUP_DAYS)
 
 
 app = dash.Dash(
@@ -28,162 +80,192 @@ server = app.server
 
 
 # Layout of Dash App
-app.layout = html.Div(
-    children=[
-        dbc.Modal(
-            [
-                dbc.ModalHeader(html.H4("Загрузка данных"), close_button=False),
-                dbc.ModalBody("Новые журналы вызовов успешно добавлены!"),
-                dbc.ModalFooter(),
-            ],
-            id="modal-upload",
-            is_open=False,
-        ),
-
-        html.Div(
-            className="row",
-            children=[
-                # Column for user controls
-                html.Div(
-                    className="three columns div-user-controls",
-                    children=[
-                        html.H1("ПРЕДСКАЗАТЕЛЬ ЗАГРУЖЕННОСТИ БРИГАД СКОРОЙ ПОМОЩИ"),
-                        html.Div(
-                            id='first-card',
-                            children=[
-                                html.H4("Загруженность подстанций за год"),
-                                html.Div(
-                                    id="div-for-all-year-graph",
-                                    children=[
-                                        dcc.Graph(id="all-year-graph", figure=graph_factory.create_total_figure()),
-                                        html.Hr(),
-                                    ],
-                                ),
+def serve_layout():
+    # функция, а не готовое дерево: шаблоны фигур берутся из снапшота, действующего на момент открытия страницы
+    graph_factory = factories.current
+    # границы выбора даты - диапазон снапшота (при скользящем горизонте он сдвигается),
+    # по умолчанию - сегодня, а если сегодня вне диапазона - его начало
+    today = dt.now()
+    initial_date = (today if graph_factory.infer_from <= today <= graph_factory.infer_to
+                    else graph_factory.infer_from).date()
+    return html.Div(
+        children=[
+            dbc.Modal(
+                [
+                    dbc.ModalHeader(html.H4("Загрузка данных"), close_button=False),
+                    dbc.ModalBody(id="upload-status"),
+                    dbc.ModalFooter(),
+                ],
+                id="modal-upload",
+                is_open=False,
+            ),
+            dcc.Store(id="upload-job"),
+            dcc.Interval(id="upload-poll", interval=2000, disabled=True),
+
+            html.Div(
+                className="row",
+                children=[
+                    # Column for user controls
+                    html.Div(
+                        className="three columns div-user-controls",
+                        children=[
+                            html.H1("ПРЕДСКАЗАТЕЛЬ ЗАГРУЖЕННОСТИ БРИГАД СКОРОЙ ПОМОЩИ"),
+                            html.Div(
+                                id='first-card',
+                                children=[
+                                    html.H4("Загруженность подстанций за год"),
+                                    html.Div(
+                                        id="div-for-all-year-graph",
+                                        children=[
+                                            dcc.Graph(id="all-year-graph", figure=total_figure(graph_factory)),
+                                            html.Hr(),
+                                        ],
+                                    ),
                                
-                            ],
-                        ),
-                        html.Div(
-                            id='second-card',
-                            children=[
-                                html.Div(
-                                    id="div-for-shap-values-graph",
-                                    children=[
-                                    ],
-                                ),
-                            ],
-                        ),
-                        html.Div(
-                            id='third-card',
-                            children=[
-                                html.Div(
-                                    id="div-for-dropdown",
-                                    className="div-center",
-                                    children=[
-                                        html.H6(
-                                    """Выберите день для просмотра ожидаемой загруженности"""
-                                        ),
-                                        dcc.DatePickerSingle(
-                                            id="date-picker",
-                                            min_date_allowed=dt(2022, 5, 25),
-                                            max_date_allowed=dt(2023, 5, 25),
-                                            initial_visible_month=dt(2022, 5, 25),
-                                            date=dt(2022, 5, 25).date(),
-                                            display_format="D MMMM, YYYY",
-                                            style={"border": "0px solid black"},
-                                        )
-                                    ],
-                                ),
-                                # Change to side-by-side for mobile layout
-                                html.Div(
-                                    className="row div-center",
-                                    children=[
-                                        html.Div(
-                                            id="day-or-hour-container",
-                                            children=[
-                                                html.H6(children="Предсказать загруженность за:"),
-                                                dcc.RadioItems(
-                                                    id="radio-hour-or-day",
-
-                                                    labelStyle={
-                                                        "margin-right": "7px",
-                                                        "display": "inline-block",
-                                                    },
-                                                    options=[
-                                                        {
-                                                            "label": "Час",
-                                                            "value": "True",
+                                ],
+                            ),
+                            html.Div(
+                                id='second-card',
+                                children=[
+                                    html.Div(
+                                        id="div-for-shap-values-graph",
+                                        style={'display': 'none'},
+                                        children=[
+                                            dcc.Graph(id="shap-graph", config={'displayModeBar': False}),
+                                            dcc.Store(id="shap-payload"),
+                                            html.Hr(),
+                                        ],
+                                    ),
+                                ],
+                            ),
+                            html.Div(
+                                id='third-card',
+                                children=[
+                                    html.Div(
+                                        id="div-for-dropdown",
+                                        className="div-center",
+                                        children=[
+                                            html.H6(
+                                        """Выберите день для просмотра ожидаемой загруженности"""
+                                            ),
+                                            dcc.DatePickerSingle(
+                                                id="date-picker",
+                                                min_date_allowed=graph_factory.infer_from,
+                                                max_date_allowed=graph_factory.infer_to,
+                                                initial_visible_month=initial_date,
+                                                date=initial_date,
+                                                display_format="D MMMM, YYYY",
+                                                style={"border": "0px solid black"},
+                                            )
+                                        ],
+                                    ),
+                                    # Change to side-by-side for mobile layout
+                                    html.Div(
+                                        className="row div-center",
+                                        children=[
+                                            html.Div(
+                                                id="day-or-hour-container",
+                                                children=[
+                                                    html.H6(children="Предсказать загруженность за:"),
+                                                    dcc.RadioItems(
+                                                        id="radio-hour-or-day",
+
+                                                        labelStyle={
+                                                            "margin-right": "7px",
+                                                            "display": "inline-block",
                                                         },
-                                                        {
-                                                            "label": "День",
-                                                            "value": "False",
+                                                        options=[
+                                                            {
+                                                                "label": "Час",
+                                                                "value": "True",
+                                                            },
+                                                            {
+                                                                "label": "День",
+                                                                "value": "False",
+                                                            },
+                                                        ],
+                                                        value="True",
+                                                    ),
+                                                ],
+                                            ),
+                                            html.Div(
+                                                id="div-for-hour-slider",
+                                                children=[
+                                                    drc.FormattedSlider(
+                                                        id="hour-slider",
+                                                        step=1,
+                                                        min=0,
+                                                        max=23,
+                                                        value=14,
+                                                        marks={
+                                                            i: "{}".format(i)
+                                                            for i in range(0, 24)
                                                         },
-                                                    ],
-                                                    value="True",
-                                                ),
-                                            ],
-                                        ),
-                                        html.Div(
-                                            id="div-for-hour-slider",
-                                            children=[
-                                                drc.FormattedSlider(
-                                                    id="hour-slider",
-                                                    step=1,
-                                                    min=0,
-                                                    max=23,
-                                                    value=14,
-                                                    marks={
-                                                        i: "{}".format(i)
-                                                        for i in range(0, 24)
-                                                    },
-                                                ),
-                                            ],
-                                        ),
-                                    ],
-                                ),
-                                html.Div(
-                                    id="div-uploading",
-                                    className='div-center',
-                                    children=[
-                                        html.H6("Добавьте ещё журналы вызовов, если требуется"),
-                                        dcc.Upload(
-                                            id='upload-data',
-                                            children=html.Div([
-                                                'Перетащите или ',
-                                                html.A('Выберите файлы')
-                                            ]),
-                                            style={
-                                                'width': '100%',
-                                                'height': '60px',
-                                                'lineHeight': '60px',
-                                                'borderWidth': '1px',
-                                                'borderStyle': 'dashed',
-                                                'borderRadius': '5px',
-                                                'textAlign': 'center',
-                                                'margin': '10px'
-                                            },
-                                            multiple=True
-                                        ),
-                                        html.Hr(),
-                                    ],
-                                ),
-                            ],
-                        ),
-                    ],
-                ),
-                # Column for app graphs and plots
-                html.Div(
-                    className="nine columns div-for-charts bg-grey",
-                    children=[
-                        html.H2("Карта загруженности"),
-                        dcc.Graph(id="map-graph", className="openstreetmap"),
-                        html.H2("Распределение за день"),
-                        dcc.Graph(id="histogram"),
-                    ],
-                ),
-            ],
-        )
-    ]
-)
+                                                    ),
+                                                ],
+                                            ),
+                                        ],
+                                    ),
+                                    html.Div(
+                                        id="div-uploading",
+                                        className='div-center',
+                                        children=[
+                                            html.H6("Добавьте ещё журналы вызовов, если требуется"),
+                                            dcc.Upload(
+                                                id='upload-data',
+                                                children=html.Div([
+                                                    'Перетащите или ',
+                                                    html.A('Выберите файлы')
+                                                ]),
+                                                style={
+                                                    'width': '100%',
+                                                    'height': '60px',
+                                                    'lineHeight': '60px',
+                                                    'borderWidth': '1px',
+                                                    'borderStyle': 'dashed',
+                                                    'borderRadius': '5px',
+                                                    'textAlign': 'center',
+                                                    'margin': '10px'
+                                                },
+                                                accept='.xls',
+                                                multiple=True
+                                            ),
+                                            html.Hr(),
+                                        ],
+                                    ),
+                                ],
+                            ),
+                        ],
+                    ),
+                    # Column for app graphs and plots
+                    html.Div(
+                        className="nine columns div-for-charts bg-grey",
+                        children=[
+                            html.H2("Карта загруженности"),
+                            dcc.Graph(id="map-graph", className="openstreetmap"),
+                            dcc.Store(id="densmap-template", data=densmap_template(graph_factory) if CLIENTSIDE_FIGURES else None),
+                            dcc.Store(id="day-block"),
+                            dcc.Store(id="templates-version", data=graph_factory.version),
+                            html.H2("Распределение за день"),
+                            dcc.Graph(id="histogram"),
+                            dcc.Store(id="histogram-template", data=histogram_template(graph_factory) if CLIENTSIDE_FIGURES else None),
+                        ],
+                    ),
+                ],
+            )
+        ]
+    )
+
+
+app.layout = serve_layout
+
+
+@server.before_request
+def check_snapshot():
+    factories.check()
+
+
+server.register_blueprint(create_api(factories), url_prefix='/api')
 
 
 @app.callback(
@@ -197,57 +279,110 @@ def radio_container(radio_value):
         return {'display': 'block'}
 
 
-@app.callback(
-    Output('map-graph', 'figure'),
-    [Input('date-picker', 'date'), Input('hour-slider', 'value'), Input('radio-hour-or-day', 'value')]
-)
-def graph_densmap(date, hour, show_hour):
-    date = pd.to_datetime(date)
-    show_hour = show_hour == 'True'
-    return graph_factory.get_densmap_figure(date, hour, show_hour)
+if CLIENTSIDE_FIGURES:
+    @app.callback(
+        [Output('day-block', 'data'), Output('densmap-template', 'data'), Output('histogram-template', 'data'),
+         Output('templates-version', 'data')],
+        [Input('date-picker', 'date')],
+        [State('templates-version', 'data')]
+    )
+    def day_block(date, templates_version):
+        graph_factory = factories.current
+        block = graph_factory.get_day_block(pd.to_datetime(date))
+        if templates_version == graph_factory.version:
+            return block, dash.no_update, dash.no_update, dash.no_update
+        # пока страница была открыта, подменился снапшот: у нового могут быть другие подстанции и их порядок,
+        # так что шаблоны (координаты, имена) отдаем заново вместе с блоком
+        return block, densmap_template(graph_factory), histogram_template(graph_factory), graph_factory.version
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='densmap', function_name='render'),
+        Output('map-graph', 'figure'),
+        [Input('day-block', 'data'), Input('hour-slider', 'value'), Input('radio-hour-or-day', 'value')],
+        [State('densmap-template', 'data')]
+    )
+
+    app.clientside_callback(
+        ClientsideFunction(namespace='histogram', function_name='render'),
+        Output('histogram', 'figure'),
+        [Input('day-block', 'data')],
+        [State('histogram-template', 'data')]
+    )
+else:
+    @app.callback(
+        Output('map-graph', 'figure'),
+        [Input('date-picker', 'date'), Input('hour-slider', 'value'), Input('radio-hour-or-day', 'value')]
+    )
+    def graph_densmap(date, hour, show_hour):
+        date = pd.to_datetime(date)
+        show_hour = show_hour == 'True'
+        return densmap_figure(factories.current, date, hour, show_hour)
+
+    @app.callback(
+        Output('histogram', 'figure'),
+        [Input('date-picker', 'date')]
+    )
+    def graph_histogram(date):
+        date = pd.to_datetime(date)
+        return histogram_figure(factories.current, date)
 
 
 @app.callback(
-    Output('histogram', 'figure'),
-    [Input('date-picker', 'date')]
+    Output('shap-payload', 'data'),
+    [Input('date-picker', 'date'), Input('map-graph', 'clickData')])
+def display_click_data(date, click_data):
+    # объяснения за весь день: слайдер часа и переключатель час/день дальше обходятся без сервера
+    if click_data is None:
+        return None
+    return factories.current.create_shap_block(click_data['points'][0]['customdata'], pd.to_datetime(date))
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='shap', function_name='render'),
+    [Output('shap-graph', 'figure'), Output('div-for-shap-values-graph', 'style')],
+    [Input('shap-payload', 'data'), Input('hour-slider', 'value'), Input('radio-hour-or-day', 'value')]
 )
-def graph_histogram(date):
-    date = date
-    return graph_factory.create_substation_daily_figure(date)
 
 
-@app.callback(
-    Output(component_id='div-for-shap-values-graph', component_property='children'),
-    [Input('date-picker', 'date'), Input('hour-slider', 'value'), Input('radio-hour-or-day', 'value'), Input('map-graph', 'clickData')])
-def display_click_data(date, hour, show_hour, click_data):
-    if click_data is not None:
-        date = pd.to_datetime(date)
-        hour = hour if show_hour == 'True' else None
-        shap_el = graph_factory.create_shap(click_data['points'][0]['customdata'], date, hour)
-        shap_html = f"<head>{shap.getjs()}</head><body>{shap_el}</body>"
-        if shap_el == 'nope':
-            return [html.Div()]
-        return [html.Div(
-                    children=[
-                        html.Iframe(
-                            srcDoc=shap_html,
-                            style={"width": "100%", "height": "175px", "border": 0},
-                        ),
-                        html.Hr(),
-                    ]
-                )
-        ]
-    return [html.Div()]
+UPLOAD_STATUS = {
+    'queued': "Журналы вызовов поставлены в очередь на обработку",
+    'running': "Журналы вызовов обрабатываются...",
+    'done': "Новые журналы вызовов успешно добавлены!",
+    'failed': "Не удалось обработать журналы вызовов",
+}
+UPLOAD_DUPLICATES = "Эти журналы вызовов уже загружены ранее: {}"
+
 
-@app.callback(Output('modal-upload', 'is_open'),
+@app.callback(Output('upload-job', 'data'),
               Input('upload-data', 'contents'),
-              State('upload-data', 'filename'),
-              State('upload-data', 'last_modified'),
-              State("modal-upload", "is_open"))
-def update_output(list_of_contents, list_of_names, list_of_dates, is_open):
-    if list_of_contents is not None:
-        return not is_open
-    return is_open
+              State('upload-data', 'filename'))
+def update_output(list_of_contents, list_of_names):
+    # только кладем файлы в очередь: разбор идет в ingest_queue.py и не занимает воркер
+    if list_of_contents is None:
+        return dash.no_update
+    files = [(name, base64.b64decode(content.split(',', 1)[1]))
+             for content, name in zip(list_of_contents, list_of_names)]
+    return ingest_queue.submit(files)
+
+
+@app.callback([Output('modal-upload', 'is_open'), Output('upload-status', 'children'),
+               Output('upload-poll', 'disabled')],
+              Input('upload-job', 'data'),
+              Input('upload-poll', 'n_intervals'))
+def upload_status(job_id, n_intervals):
+    if job_id is None:
+        return dash.no_update, dash.no_update, True
+    job = ingest_queue.status(job_id)
+    state = job['state'] if job is not None else 'failed'
+    finished = state in ('done', 'failed')
+    # окно открываем при загрузке и еще раз по окончании, а не на каждом опросе
+    just_submitted = dash.callback_context.triggered[0]['prop_id'] == 'upload-job.data'
+    is_open = True if just_submitted or finished else dash.no_update
+    message = UPLOAD_STATUS[state]
+    if job is not None and job.get('skipped'):
+        duplicates = UPLOAD_DUPLICATES.format(', '.join(job['skipped']))
+        message = duplicates if not job['files'] else f'{message} {duplicates}'
+    return is_open, message, finished
 
 
 if __name__ == "__main__":
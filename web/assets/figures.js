@@ -0,0 +1,110 @@
+// Фигуры без запросов к серверу: шаблоны (координаты, подписи, layout) приходят один раз вместе с layout,
+// блок дня (24 x N вызовов + сумма за день) - при смене даты. Шаблон не копируется целиком:
+// меняются только трейсы, а layout остается тем же объектом, и Plotly.react не перестраивает карту и оси.
+// Блок и шаблоны сопоставляются по позициям подстанций, поэтому рисуем, только если они от одного снапшота
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    densmap: {
+        render: function (block, hour, showHour, template) {
+            if (!template || (block && block.version !== template.version)) {
+                return window.dash_clientside.no_update;
+            }
+            var z = null;
+            if (block) {
+                z = showHour === 'True' ? block.hourly[hour] : block.daily;
+            }
+            var trace = Object.assign({}, template.figure.data[0]);
+            if (z) {
+                trace.z = z;
+            } else {
+                // дня или часа нет в прогнозе - пустая карта, как и на сервере
+                trace.lat = [];
+                trace.lon = [];
+                trace.z = [];
+                trace.customdata = [];
+            }
+            return {data: [trace], layout: template.figure.layout};
+        }
+    },
+    histogram: {
+        render: function (block, template) {
+            if (!block || !template || block.version !== template.version) {
+                return window.dash_clientside.no_update;
+            }
+            var x = [];
+            var rows = [];
+            block.hourly.forEach(function (calls, hour) {
+                if (calls) {
+                    x.push(block.date + 'T' + (hour < 10 ? '0' : '') + hour + ':00:00');
+                    rows.push(calls);
+                }
+            });
+            var data = template.figure.data.map(function (trace, i) {
+                var sub = template.order[i];
+                return Object.assign({}, trace, {
+                    x: x,
+                    y: rows.map(function (calls) { return calls[sub]; })
+                });
+            });
+            return {data: data, layout: template.figure.layout};
+        }
+    },
+    shap: {
+        // объяснения из GraphFactory.create_shap_block (за день и за каждый час): горизонтальные столбики вкладов,
+        // самый сильный - сверху, в цветах shap.force_plot (красный - увеличивает прогноз, синий - уменьшает)
+        render: function (block, hour, showHour) {
+            var payload = null;
+            if (block) {
+                payload = showHour === 'True' ? block.hourly[hour] : block.daily;
+            }
+            if (!payload) {
+                return [{data: [], layout: {}}, {display: 'none'}];
+            }
+            var format = function (value) {
+                if (typeof value !== 'number' || Number.isInteger(value)) {
+                    return String(value);
+                }
+                return String(Number(value.toPrecision(4)));
+            };
+            var labels = payload.features.map(function (name, i) {
+                return name + ' = ' + format(payload.values[i]);
+            });
+            var contributions = payload.contributions.slice();
+            // для дня (сумма часов) есть еще средний |вклад| за час
+            var impact = payload.impact ? payload.impact.slice() : null;
+            if (payload.other !== 0) {
+                labels.push('остальные фичи');
+                contributions.push(payload.other);
+                if (impact) {
+                    impact.push(null);
+                }
+            }
+            labels.reverse();
+            contributions.reverse();
+            var trace = {
+                type: 'bar',
+                orientation: 'h',
+                x: contributions,
+                y: labels,
+                marker: {color: contributions.map(function (c) { return c > 0 ? '#ff0051' : '#008bfb'; })},
+                hovertemplate: '%{y}<br><b>Вклад:</b> %{x:.3f}<extra></extra>'
+            };
+            if (impact) {
+                trace.customdata = impact.reverse();
+                trace.hovertemplate = '%{y}<br><b>Вклад за день:</b> %{x:.3f}<br>' +
+                    '<b>Средний |вклад| за час:</b> %{customdata:.3f}<extra></extra>';
+            }
+            var layout = {
+                title: {
+                    text: payload.substation + ', ' + payload.date_time + ': ' + format(payload.base_value) +
+                        ' → ' + format(payload.prediction),
+                    font: {size: 13}
+                },
+                height: 60 + 22 * labels.length,
+                margin: {r: 3, t: 30, l: 3, b: 20},
+                yaxis: {automargin: true},
+                showlegend: false
+            };
+            return [{data: [trace], layout: layout}, {display: 'block'}];
+        }
+    }
+});
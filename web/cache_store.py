@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Dict, Any, Optional, Tuple
+
+import numpy as np
+
+FORMAT_VERSION = 5
+MANIFEST_NAME = 'manifest.json'
+POINTER_NAME = 'CURRENT'
+
+
+def hash_path(path: str) -> str:
+    # sha1 по содержимому файла или всех файлов папки (вместе с относительными путями)
+    sha = hashlib.sha1()
+    if os.path.isdir(path):
+        files = sorted(os.path.relpath(os.path.join(root, name), path)
+                       for root, _, names in os.walk(path) for name in names)
+    else:
+        files = ['']
+    for rel_path in files:
+        sha.update(rel_path.encode('utf-8'))
+        with open(os.path.join(path, rel_path) if rel_path else path, 'rb') as f:
+            for buf in iter(lambda: f.read(1 << 20), b''):
+                sha.update(buf)
+    return sha.hexdigest()
+
+
+# кэш предсказаний - папка со снапшотами: в каждом по файлу .npy на массив, копии моделей и подстанций,
+# из которых он посчитан, и manifest.json с ключом. Какой снапшот действующий - написано в файле CURRENT,
+# который подменяется атомарно; снапшоты не меняются после публикации, так что воркеры могут
+# спокойно дочитывать старый, пока не переключатся на новый.
+# массивы открываются через mmap, так что открытие снапшота почти ничего не стоит
+class CacheStore:
+    def __init__(self, path: str, keep: int = 2):
+        self.path = path
+        self.keep = keep
+
+    def current(self) -> Optional[str]:
+        try:
+            with open(os.path.join(self.path, POINTER_NAME), 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def load(self, key: Optional[Dict[str, Any]] = None
+             ) -> Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any], Dict[str, Any], str]]:
+        # опубликованный снапшот: (массивы, meta, ключ, папка). Если key задан и не совпал - снапшот устарел
+        name = self.current()
+        if name is None:
+            return None
+        return self.load_path(os.path.join(self.path, name), key)
+
+    def load_path(self, snapshot_path: str, key: Optional[Dict[str, Any]] = None
+                  ) -> Optional[Tuple[Dict[str, np.ndarray], Dict[str, Any], Dict[str, Any], str]]:
+        # снапшот по папке (ее возвращает save), а не по CURRENT: его мог уже переставить другой процесс
+        manifest_path = os.path.join(snapshot_path, MANIFEST_NAME)
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('format') != FORMAT_VERSION or (key is not None and manifest.get('key') != key):
+            return None
+        arrays = {name: np.load(os.path.join(snapshot_path, file), mmap_mode='r')
+                  for name, file in manifest['artifacts'].items()}
+        return arrays, manifest['meta'], manifest['key'], snapshot_path
+
+    def save(self, key: Dict[str, Any], arrays: Dict[str, np.ndarray], meta: Dict[str, Any],
+             copy_paths: Optional[Dict[str, str]] = None, link_paths: Optional[Dict[str, str]] = None) -> str:
+        # собираем снапшот во временной папке, переименовываем и только потом переставляем CURRENT
+        key_hash = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{key_hash}-{os.getpid()}'
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = os.path.join(self.path, f'.tmp-{name}')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        artifacts = {}
+        for i, (array_name, array) in enumerate(arrays.items()):
+            artifacts[array_name] = f'{i:04d}.npy'
+            np.save(os.path.join(tmp_path, artifacts[array_name]), np.ascontiguousarray(array))
+        for target, source in (copy_paths or {}).items():
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(tmp_path, target))
+            else:
+                shutil.copy2(source, os.path.join(tmp_path, target))
+        # link_paths - из другого снапшота: они не меняются после публикации, так что файлы можно делить
+        # жесткими ссылками вместо копий
+        for target, source in (link_paths or {}).items():
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(tmp_path, target), copy_function=os.link)
+            else:
+                os.link(source, os.path.join(tmp_path, target))
+        with open(os.path.join(tmp_path, MANIFEST_NAME), 'w') as f:
+            json.dump({'format': FORMAT_VERSION, 'key': key, 'artifacts': artifacts, 'meta': meta}, f,
+                      ensure_ascii=False, indent=1)
+        os.rename(tmp_path, os.path.join(self.path, name))
+
+        pointer_tmp = os.path.join(self.path, f'.{POINTER_NAME}-{os.getpid()}')
+        with open(pointer_tmp, 'w') as f:
+            f.write(name)
+        os.replace(pointer_tmp, os.path.join(self.path, POINTER_NAME))
+        self._cleanup()
+        return os.path.join(self.path, name)
+
+    def _cleanup(self):
+        # оставляем keep последних снапшотов: на предыдущем еще могут работать воркеры,
+        # а mmap уже удаленных файлов остаются валидными
+        snapshots = sorted(name for name in os.listdir(self.path)
+                           if os.path.isfile(os.path.join(self.path, name, MANIFEST_NAME)))
+        current = self.current()
+        for name in snapshots[:-self.keep]:
+            if name != current:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
@@ -1,7 +1,11 @@
+import gc
+
 bind = '0.0.0.0:8050'
 backlog = 2048
 workers = 8
 worker_class = 'sync'
+# app.py (а с ним предсказания и модели) грузится один раз в мастере, воркеры делят память через copy-on-write
+preload_app = True
 worker_connections = 1000
 timeout = 30
 keepalive = 2
@@ -19,6 +23,9 @@ def pre_exec(server):
     server.log.info("Forked child, re-executing.")
 
 def when_ready(server):
+    # загруженные объекты уезжают в постоянное поколение, чтобы сборщик мусора в воркерах
+    # не трогал их заголовки и не копировал страницы
+    gc.freeze()
     server.log.info("Server is ready. Spawning workers")
 
 def worker_abort(worker):
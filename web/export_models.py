@@ -0,0 +1,38 @@
+import argparse
+import sys
+from pathlib import Path
+from typing import List
+
+from predictor import BUNDLE_NAME, ModelRegistry, save_bundle
+
+
+def export_models(model_dir: Path, output_dir: Path, fmt: str = 'bundle'):
+    # для каждой подстанции: 5 моделей с разными seed -> одна (catboost.sum_models с весами 0.2),
+    # trend/shrink из sklearn -> коэффициенты. bundle - все подстанции в одном файле models.bundle,
+    # dir - model.cbm + corrections.json в папке каждой подстанции. Pickle-файлы не трогаем
+    registry = ModelRegistry(str(model_dir), serving=False)
+    fused = {}
+    for target, target_models in registry.targets.items():
+        print(f': {target}: {len(target_models.models)} models -> 1')
+        fused[target] = target_models.fused()
+    if fmt == 'bundle':
+        output_dir.mkdir(parents=True, exist_ok=True)
+        save_bundle(fused, str(output_dir / BUNDLE_NAME))
+    else:
+        for target, target_models in fused.items():
+            target_models.save(str(output_dir / target))
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Слить ансамбли моделей подстанций в серверный вид '
+                                                 '(models.bundle или model.cbm + corrections.json), '
+                                                 'который предпочитает ModelRegistry')
+    parser.add_argument('--models', type=Path, default=Path('../models'))
+    parser.add_argument('--output', type=Path, default=None, help='по умолчанию - рядом с исходными моделями')
+    parser.add_argument('--format', choices=['bundle', 'dir'], default='bundle')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    export_models(args.models, args.output or args.models, args.format)
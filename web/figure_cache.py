@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import plotly.graph_objects as go
+
+
+# готовые фигуры по ключу из входов коллбэка: в памяти процесса - LRU из уже разобранных dict,
+# за ним - общий для всех воркеров sqlite-файл с сериализованным JSON и вытеснением по объему
+class FigureCache:
+    def __init__(self, path: Optional[str] = None, max_items: int = 1024, max_bytes: int = 512 * 2 ** 20):
+        self.path = path
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger()
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._inherited = []
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        if self.path is None:
+            return None
+        # соединение нельзя тащить через fork, так что у каждого воркера - свое. Унаследованное от мастера
+        # (с preload_app его открывает прогрев и serve_layout) не трогаем и не закрываем: close в воркере
+        # сочтет его последним соединением и сделает checkpoint WAL под ногами у остальных. Поэтому держим
+        # на него ссылку, чтобы его не закрыл и сборщик мусора
+        if self._conn is not None and self._conn_pid != os.getpid():
+            self._inherited.append(self._conn)
+            self._conn = None
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS figures '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS figures_used ON figures (used)')
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    def _remember(self, key: str, figure: dict):
+        with self._lock:
+            self._memory[key] = figure
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            figure = self._memory.get(key)
+            if figure is not None:
+                self._memory.move_to_end(key)
+                return figure
+        try:
+            db = self._db()
+            row = db.execute('SELECT value FROM figures WHERE key = ?', (key,)).fetchone() if db else None
+            if row is None:
+                return None
+            db.execute('UPDATE figures SET used = ? WHERE key = ?', (time.time(), key))
+        except sqlite3.Error as e:
+            self.logger.warning(f'Figure cache is unavailable: {e}')
+            return None
+        figure = json.loads(row[0])
+        self._remember(key, figure)
+        return figure
+
+    def put(self, key: str, payload: str) -> dict:
+        figure = json.loads(payload)
+        self._remember(key, figure)
+        try:
+            db = self._db()
+            if db is not None:
+                db.execute('INSERT OR REPLACE INTO figures VALUES (?, ?, ?, ?)',
+                           (key, payload, len(payload), time.time()))
+                # выкидываем самые давно использованные, пока не уложимся в max_bytes
+                db.execute('DELETE FROM figures WHERE key IN (SELECT key FROM ('
+                           'SELECT key, SUM(size) OVER (ORDER BY used DESC) AS total FROM figures'
+                           ') WHERE total > ?)', (self.max_bytes,))
+        except sqlite3.Error as e:
+            self.logger.warning(f'Figure cache is unavailable: {e}')
+        return figure
+
+    def get_or_create(self, key: str, make_figure: Callable[[], go.Figure]) -> dict:
+        figure = self.get(key)
+        if figure is None:
+            figure = self.put(key, make_figure().to_json())
+        return figure
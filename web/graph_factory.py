@@ -1,94 +1,264 @@
 import datetime as dt
+import functools
+import hashlib
+import json
 import logging
-import os.path
-import pickle
-from typing import Optional
+import os
+from typing import Any, Dict, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-import shap
 
-from predictor import make_predictions
+from cache_store import CacheStore, hash_path
+from predictor import make_features, make_predictions, make_shap_values, ModelRegistry
+from rollups import Rollup, build_rollups, compact_calls, rollups_from_arrays, rollups_to_arrays
+from shap_store import QuantizedShap, merge_shap
 from substation import load_substations
 
+SNAPSHOT_MODELS = 'models'
+SNAPSHOT_SUBSTATIONS = 'substations.json'
+SHAP_TOP_K = 10  # сколько самых сильных вкладов отдавать в объяснении, остальные - одной суммой
+
+
+def _same_models(key: Dict[str, Any], other: Dict[str, Any]) -> bool:
+    # ключи снапшотов, отличающиеся только диапазоном дат
+    return all(key.get(name) == other.get(name) for name in set(key) | set(other)
+               if name not in ('infer_from', 'infer_to'))
+
+
+def _compute_hours_shap(registry: ModelRegistry, substation: str, start: pd.Timestamp, hours: int) -> QuantizedShap:
+    # SHAP часов [start, start + hours) зависит только от моделей и самих часов, но не от снапшота,
+    # так что кэш по этим аргументам переживает сдвиг окна (см. GraphFactory.adopt).
+    # в один поток: воркер gunicorn форкается от мастера, где пул потоков catboost уже поднят,
+    # да и ядра и так поделены между воркерами
+    features = make_features(pd.DataFrame({'date': pd.date_range(start, periods=hours, freq='1H')}))
+    values = make_shap_values(registry.targets[substation], features, thread_count=1)
+    # в кэше держим в том же квантованном виде, что и в снапшоте - влезает в 4 раза больше дней
+    return QuantizedShap.from_values(values, SHAP_TOP_K)
+
+
+def _json_value(value):
+    # numpy-скаляры (bool_, int64, float64) -> обычные значения для JSON
+    return value.item() if isinstance(value, np.generic) else value
+
 
 class GraphFactory:
-    predictions_daily: Optional[pd.DataFrame]
-    predictions_hourly: Optional[pd.DataFrame]
     predictions: Optional[pd.DataFrame]
-    shap_values: Optional[np.ndarray]
+    shap_values: Optional[Dict[str, QuantizedShap]]
     features: Optional[pd.DataFrame]
+    registry: Optional[ModelRegistry]
+    version: Optional[str]
+    snapshot_path: Optional[str]
+    snapshot_key: Optional[Dict[str, Any]]
+    # предсказания пирамидой агрегатов: rollups['hour' | 'day' | 'week' | 'month'].calls[период, подстанция]
+    rollups: Optional[Dict[str, Rollup]]
+    substation_names: Optional[np.ndarray]
+    lat: Optional[np.ndarray]
+    lon: Optional[np.ndarray]
+    # координаты подстанций (index - имя) в порядке substation_names
+    substations: Optional[pd.DataFrame]
 
     def __init__(self, substations_path: str, model_path: str, infer_from: dt.datetime, infer_to: dt.datetime,
-                 cache_path: str):
+                 cache_path: str, workers: int = 1, lazy_shap: bool = True, shap_cache_size: int = 256):
         self.substations_path = substations_path
         self.model_path = model_path
         self.infer_from = infer_from
         self.infer_to = infer_to
         self.cache_path = cache_path
+        self.workers = workers
+        self.lazy_shap = lazy_shap
         self.logger = logging.getLogger()
+        # SHAP считается по клику для (подстанция, день) и держится в ограниченном LRU
+        self._hours_shap = functools.lru_cache(maxsize=shap_cache_size)(_compute_hours_shap)
+        self._day_explanation = functools.lru_cache(maxsize=shap_cache_size)(self._compute_day_explanation)
 
-        self.predictions_daily = None
-        self.predictions_hourly = None
         self.shap_values = None
         self.features = None
+        self.registry = None
+        self.version = None
+        self.snapshot_path = None
+        self.snapshot_key = None
+        self.rollups = None
+        self.substation_names = None
+        self.lat = None
+        self.lon = None
+        self.substations = None
+
+    def get_registry(self) -> ModelRegistry:
+        if self.registry is None:
+            self.logger.info('Loading models...')
+            self.registry = ModelRegistry(os.path.join(self.snapshot_path, SNAPSHOT_MODELS))
+        return self.registry
+
+    def cache_key(self):
+        return {
+            'models': hash_path(self.model_path),
+            'substations': hash_path(self.substations_path),
+            'infer_from': self.infer_from.isoformat(),
+            'infer_to': self.infer_to.isoformat(),
+            'shap': not self.lazy_shap,
+            'shap_top_k': SHAP_TOP_K
+        }
 
     def load(self):
-        if os.path.isfile(self.cache_path):
-            with open(self.cache_path, 'rb') as f:
-                cache = pickle.load(f)
-            self.predictions_daily = cache['predictions_daily']
-            self.predictions_hourly = cache['predictions_hourly']
-            self.predictions = cache['predictions']
-            self.shap_values = cache['shap_values']
-            self.features = cache['features']
+        # снапшот под текущие модели, подстанции и диапазон; если опубликован другой - считаем и публикуем свой
+        cache_store = CacheStore(self.cache_path)
+        key = self.cache_key()
+        snapshot = cache_store.load(key)
+        registry = None
+        if snapshot is None:
+            # открываем именно свой снапшот: CURRENT к этому моменту мог переставить другой публикующий процесс
+            registry, snapshot_path = self.build(cache_store, key)
+            snapshot = cache_store.load_path(snapshot_path, key)
+        self._open(*snapshot)
+        # модели в снапшоте - копия только что загруженных, второй раз их не читаем
+        self.registry = registry
+
+    def load_published(self) -> bool:
+        # то, что сейчас опубликовано в cache_path, без сверки с model_path и диапазоном дат:
+        # так воркеры подхватывают снапшоты, собранные в другом процессе (см. snapshot.py)
+        snapshot = CacheStore(self.cache_path).load()
+        if snapshot is None:
+            return False
+        self._open(*snapshot)
+        return True
+
+    def adopt(self, previous: 'GraphFactory') -> bool:
+        # снапшот от тех же моделей, что и у previous (сдвинулось только окно дат): берем уже загруженные
+        # модели - в воркере это общая с мастером копия - и SHAP, посчитанный по кликам
+        if previous.snapshot_key is None or not _same_models(self.snapshot_key, previous.snapshot_key):
+            return False
+        self.registry = previous.get_registry()
+        self._hours_shap = previous._hours_shap
+        return True
+
+    def build(self, cache_store: CacheStore, key: Dict[str, Any]) -> Tuple[Optional[ModelRegistry], str]:
+        # модели грузим, только если есть что досчитывать: при сдвиге окна на час это дешевле всего остального
+        registry = None
+        dates = pd.DatetimeIndex(pd.date_range(self.infer_from, self.infer_to, freq='1H'))
+        # часы, которые уже есть в опубликованном снапшоте от тех же моделей, не пересчитываем:
+        # прогноз на час зависит только от самого часа, так что сдвиг диапазона стоит только новых часов
+        base = cache_store.load()
+        if base is not None and not _same_models(base[2], key):
+            base = None
+        if base is not None:
+            base_arrays, base_meta = base[0], base[1]
+            names = list(base_meta['substations'])
+            base_rows = pd.DatetimeIndex(base_arrays['rollup/hour/index']).get_indexer(dates)
         else:
-            self.logger.info('Loading substations...')
-            substations = load_substations(self.substations_path)
+            base_arrays, names, base_rows = None, None, np.full(len(dates), -1)
+        known = base_rows >= 0
+        missing = dates[~known]
 
-            self.logger.info('Making predictions...')
-            predictions, shap_values, features = make_predictions(
-                pd.DataFrame({'date': pd.date_range(self.infer_from, self.infer_to, freq='1H')}),
-                self.model_path
+        self.logger.info(f'Making predictions for {len(missing)} of {len(dates)} hours...')
+        predictions, shap_values = None, None
+        if len(missing) > 0:
+            registry = ModelRegistry(self.model_path)
+            predictions, shap_values, _ = make_predictions(
+                pd.DataFrame({'date': missing}),
+                registry,
+                workers=self.workers,
+                with_shap=not self.lazy_shap
             )
-            self.predictions = predictions
-            self.shap_values = shap_values
-            self.features = features
-
-            #  по дате
-            pred_daily = predictions.groupby(predictions['date_time'].dt.date).sum().reset_index().melt(
-                id_vars=['date_time'],
-                var_name='substation',
-                value_name='calls'
-            )
-            pred_daily = pred_daily.join(substations, on='substation')
-            pred_daily['date_time'] = pd.to_datetime(pred_daily['date_time'])
-            self.predictions_daily = pred_daily
-
-            #  по часам
-            pred_hourly = predictions.melt(id_vars=['date_time'], var_name='substation', value_name='calls')
-            pred_hourly = pred_hourly.join(substations, on='substation')
-            self.predictions_hourly = pred_hourly
-
-            with open(self.cache_path, 'wb') as f:
-                pickle.dump({
-                    'predictions_daily': self.predictions_daily,
-                    'predictions_hourly': self.predictions_hourly,
-                    'predictions': self.predictions,
-                    'shap_values': self.shap_values,
-                    'features': self.features
-                }, f)
+            names = names or list(predictions.columns[1:])
+
+        def assemble(old_name: str, new_values: Optional[np.ndarray]) -> np.ndarray:
+            width = (base_arrays[old_name] if base_arrays is not None else new_values).shape[1]
+            values = np.empty((len(dates), width), dtype=np.float64)
+            if known.any():
+                values[known] = base_arrays[old_name][base_rows[known]]
+            if new_values is not None:
+                values[~known] = new_values
+            return values
+
+        calls = assemble('rollup/hour/calls', predictions[names].to_numpy(dtype=np.float64)
+                         if predictions is not None else None)
+        # почасовой прогноз хранится один раз - как нижний уровень пирамиды
+        arrays = rollups_to_arrays(build_rollups(dates, compact_calls(calls), np.array(names, dtype=object)))
+        if not self.lazy_shap:
+            # SHAP хранится квантованным (int16 + масштаб на фичу) вместе с top-k индексом на час
+            for name in names:
+                base_shap = None if base_arrays is None else QuantizedShap.from_arrays(base_arrays, f'shap/{name}')
+                new_shap = shap_values[name] if shap_values else None
+                arrays.update(merge_shap(base_shap, base_rows, new_shap, SHAP_TOP_K).to_arrays(f'shap/{name}'))
+        # модели и подстанции копируются в снапшот, чтобы он не зависел от того, что потом положат в model_path;
+        # если они те же, что в базовом снапшоте, - жесткие ссылки на его файлы
+        if base is not None:
+            snapshot_path = cache_store.save(key, arrays, {'substations': names}, link_paths={
+                SNAPSHOT_MODELS: os.path.join(base[3], SNAPSHOT_MODELS),
+                SNAPSHOT_SUBSTATIONS: os.path.join(base[3], SNAPSHOT_SUBSTATIONS)})
+        else:
+            snapshot_path = cache_store.save(key, arrays, {'substations': names},
+                                             {SNAPSHOT_MODELS: self.model_path,
+                                              SNAPSHOT_SUBSTATIONS: self.substations_path})
+        return registry, snapshot_path
+
+    def _open(self, arrays: Dict[str, np.ndarray], meta: Dict[str, Any], key: Dict[str, Any], snapshot_path: str):
+        # версия данных - чтобы кэши поверх GraphFactory (например, готовых фигур) не отдавали устаревшее.
+        # порядок подстанций тоже входит: по нему браузер сопоставляет блок дня с шаблонами фигур
+        version_data = json.dumps([key, meta['substations']], sort_keys=True, ensure_ascii=False)
+        self.version = hashlib.sha1(version_data.encode('utf-8')).hexdigest()[:12]
+        self.snapshot_path = snapshot_path
+        self.snapshot_key = key
+        self.infer_from = dt.datetime.fromisoformat(key['infer_from'])
+        self.infer_to = dt.datetime.fromisoformat(key['infer_to'])
+        self.lazy_shap = not key['shap']
+        self.rollups = rollups_from_arrays(arrays)
+        hourly = self.rollups['hour']
+        self.predictions = pd.DataFrame(hourly.calls, columns=meta['substations'], copy=False)
+        self.predictions.insert(0, 'date_time', hourly.index)
+        self.features = make_features(pd.DataFrame({'date': self.predictions['date_time']}))
+        self.shap_values = None if self.lazy_shap else \
+            {name: QuantizedShap.from_arrays(arrays, f'shap/{name}') for name in meta['substations']}
+
+        self.logger.info('Loading substations...')
+        substations = load_substations(os.path.join(snapshot_path, SNAPSHOT_SUBSTATIONS))
+        self.substation_names = np.array(self.predictions.columns[1:], dtype=object)
+        self.substations = substations.reindex(self.substation_names)
+        self.lat = self.substations['lat'].to_numpy()
+        self.lon = self.substations['lon'].to_numpy()
+
+    def _day_rows(self, day: pd.Timestamp) -> np.ndarray:
+        daily = self.rollups['day']
+        i = daily.row(pd.Timestamp(day).normalize())
+        return np.arange(0) if i is None else daily.finer_rows(i, self.rollups['hour'])
+
+    def get_shap(self, substation: str, day) -> Tuple[np.ndarray, QuantizedShap]:
+        # строки predictions за день и SHAP-значения для них ([часы, фичи + 1], см. QuantizedShap.decode)
+        day = pd.to_datetime(day).normalize()
+        rows = self._day_rows(day)
+        if self.shap_values is not None:
+            return rows, self.shap_values[substation].take(rows)
+        return rows, self._hours_shap(self.get_registry(), substation, self.rollups['hour'].index[rows[0]], len(rows))
+
+    def missing_hours(self, date_from: pd.Timestamp, date_to: pd.Timestamp) -> int:
+        # сколько часов из [date_from, date_to] нет в снапшоте - их get_hourly_forecast будет досчитывать
+        dates = pd.date_range(date_from, date_to, freq='1H')
+        return int((self.rollups['hour'].index.get_indexer(dates) < 0).sum())
+
+    def get_hourly_forecast(self, date_from: pd.Timestamp, date_to: pd.Timestamp
+                            ) -> Tuple[pd.DatetimeIndex, np.ndarray]:
+        # прогноз по часам [date_from, date_to] x подстанции: что есть в снапшоте - оттуда, остальное досчитываем
+        dates = pd.DatetimeIndex(pd.date_range(date_from, date_to, freq='1H'))
+        hourly = self.rollups['hour']
+        rows = hourly.index.get_indexer(dates)
+        known = rows >= 0
+        calls = np.empty((len(dates), len(self.substation_names)), dtype=np.float64)
+        calls[known] = hourly.calls[rows[known]]
+        if not known.all():
+            # в один поток, как и SHAP по клику (см. _compute_hours_shap)
+            predictions, _, _ = make_predictions(pd.DataFrame({'date': dates[~known]}), self.get_registry(),
+                                                 with_shap=False, thread_count=1)
+            calls[~known] = predictions[list(self.substation_names)].to_numpy(dtype=np.float64)
+        return dates, calls
 
     def create_total_figure(self):
-        pred_daily = self.predictions_daily.copy()
-        pred_daily['date_time'] = pred_daily['date_time'] - pd.to_timedelta(pred_daily['date_time'].dt.dayofweek, unit='d')
-        pred_daily = pred_daily.groupby(['date_time', 'substation'])['calls'].sum().reset_index()
-        unique = pred_daily.groupby('substation')['calls'].mean().sort_values(ascending=True).index.to_numpy()
+        weekly = self.rollups['week']
+        x = weekly.index.to_numpy()
         fig = go.Figure()
-        for sub in unique:
-            pred_sub = pred_daily[pred_daily['substation'] == sub]
-            fig.add_trace(go.Bar(x=np.array(pred_sub['date_time']), y=np.array(pred_sub['calls']), name=sub))
+        for sub in weekly.order:
+            fig.add_trace(go.Bar(x=x, y=weekly.calls[:, sub], name=self.substation_names[sub]))
         fig.update_layout(barmode='stack')
         fig.update_layout(showlegend=False)
         fig.update_layout(margin={"r": 1, "t": 1, "l": 1, "b": 1})
@@ -97,13 +267,33 @@ class GraphFactory:
 
     def get_densmap_figure(self, date, hour, show_hours):
         date = pd.to_datetime(date)
-        if show_hours:
-            cut_df = self.predictions_hourly[self.predictions_hourly['date_time'] == pd.to_datetime(date + dt.timedelta(hours=hour))]
-        else:
-            cut_df = self.predictions_daily[self.predictions_daily['date_time'] == date]
-        # customdata =
-        densmap = go.Densitymapbox(lat=cut_df['lat'], lon=cut_df['lon'], z=cut_df['calls'],
-                                   customdata=cut_df['substation'],
+        rollup = self.rollups['hour'] if show_hours else self.rollups['day']
+        row = rollup.row(date + dt.timedelta(hours=hour) if show_hours else date)
+        if row is None:
+            return self._densmap_figure([], [], [], [])
+        return self._densmap_figure(self.lat, self.lon, rollup.calls[row], self.substation_names)
+
+    def create_densmap_template(self):
+        # карта без z: координаты и подписи уходят в браузер один раз, z подставляет clientside-коллбэк
+        return self._densmap_figure(self.lat, self.lon, [], self.substation_names)
+
+    def get_day_block(self, date) -> dict:
+        # все, что нужно браузеру, чтобы листать часы выбранного дня без запросов к серверу:
+        # hourly[час] - вызовы по подстанциям (None, если часа нет в прогнозе), daily - сумма за день
+        hourly, daily = self.rollups['hour'], self.rollups['day']
+        date = pd.to_datetime(date).normalize()
+        hours = [None] * 24
+        for row in self._day_rows(date):
+            hours[hourly.index[row].hour] = hourly.calls[row].tolist()
+        row = daily.row(date)
+        # version - чтобы браузер не наложил блок нового снапшота на шаблоны старого (см. app.day_block)
+        return {'version': self.version, 'date': f'{date:%Y-%m-%d}', 'hourly': hours,
+                'daily': daily.calls[row].tolist() if row is not None else None}
+
+    @staticmethod
+    def _densmap_figure(lat, lon, z, names):
+        densmap = go.Densitymapbox(lat=lat, lon=lon, z=z,
+                                   customdata=names,
                                    hovertemplate=r'''<b>Вызовов:</b> %{z}<br><b>Подстанция: </b>%{customdata} <extra></extra>''',
                                    radius=80)
         fig = go.Figure(densmap)
@@ -117,46 +307,79 @@ class GraphFactory:
         return fig
 
     def create_substation_daily_figure(self, date):
-        pred_hourly = self.predictions_hourly
-        unique = pred_hourly.groupby('substation')['calls'].mean().sort_values(ascending=True).index.to_numpy()
+        hourly = self.rollups['hour']
+        rows = self._day_rows(pd.to_datetime(date))
+        return self._histogram_figure(hourly.index[rows].to_numpy(), hourly.calls[rows])
+
+    def create_histogram_template(self):
+        # столбики без данных в порядке hourly.order: x и y по блоку дня подставляет браузер
+        return self._histogram_figure([], np.zeros((0, len(self.substation_names))))
+
+    def _histogram_figure(self, x, day_calls):
+        hourly = self.rollups['hour']
         fig = go.Figure()
-        pred_hrl = pred_hourly[(pd.to_datetime((pred_hourly['date_time']).dt.date) == pd.to_datetime(date))]
-        for sub in unique:
-            pred_sub = pred_hrl[(pred_hrl['substation'] == sub)]
-            fig.add_trace(go.Bar(x=np.array(pred_sub['date_time']), y=np.array(pred_sub['calls']), name=sub))
+        for sub in hourly.order:
+            fig.add_trace(go.Bar(x=x, y=day_calls[:, sub], name=self.substation_names[sub]))
         fig.update_layout(barmode='stack')
         fig.update_layout(margin={"r": 1, "t": 1, "l": 1, "b": 1})
         return fig
 
-    def create_shap(self, substation, day, hour=None):
-        pred = self.predictions
-        shap_vs = self.shap_values
-        feature_df = self.features
-        if hour is not None:
-            date = pd.to_datetime(day) + dt.timedelta(hours=hour)
-            idx = pred[pred['date_time'] == date].index[0]
-            return shap.force_plot(shap_vs[substation][idx][-1], shap_vs[substation][idx][:-1],
-                                   features=feature_df.iloc[idx], show=False, matplotlib=False).html()
-        else:
-            # date = pd.to_datetime(day)
-            # idx = pred[pd.to_datetime(pred['date_time'].dt.date) == date].index
-            # shaps = shap_vs[substation][idx]
-            # shap.summary_plot(shaps[:, :-1], features=feature_df.iloc[idx], show=False)
-            # # plot = shap.plots.beeswarm(shaps[:, :-1])
-            # # return plot.html()
-            # fig = plt.gcf()
-            # tmpfile = BytesIO()
-            # fig.savefig(tmpfile, format='png')
-            # encoded = base64.b64encode(tmpfile.getvalue()).decode('utf-8')
-
-            # return '<img src=\'data:image/png;base64,{}\'>'.format(encoded)
-
+    def create_shap(self, substation, day, hour=None, top_k: int = SHAP_TOP_K) -> Optional[dict]:
+        # объяснение в виде небольшого JSON: базовое значение и top_k самых сильных вкладов с значениями фич,
+        # остальные фичи - одной суммой. Рисует его assets/figures.js
+        day = pd.to_datetime(day).normalize()
+        if substation not in self.substation_names:
+            # клик по карте, нарисованной по прошлому снапшоту, где была такая подстанция
+            return None
+        if hour is None:
+            return self._day_explanation(substation, day, top_k)
+        date = day + dt.timedelta(hours=hour)
+        idx = self.rollups['hour'].row(date)
+        if idx is None:
+            return None
+        rows, day_shap = self.get_shap(substation, day)
+        i = np.searchsorted(rows, idx)
+        shap_row = day_shap.decode(i).astype(np.float64)
+        contributions = shap_row[:-1]
+        # порядок вкладов посчитан заранее по точным значениям; больше сохраненного - сортируем сами
+        top = day_shap.top[i, :top_k].astype(np.intp) if top_k <= day_shap.top.shape[1] else \
+            np.argsort(-np.abs(contributions), kind='stable')[:top_k]
+        values = [_json_value(v) for v in self.features.iloc[idx].iloc[top]]
+        return self._explanation(substation, f'{date:%Y-%m-%d %H:%M}', shap_row, contributions, top, values)
 
-            # canvas = FigureCanvas(fig)
-            # png_output = StringIO()
-            # canvas.print_png(png_output)
-            # data = png_output.getvalue().encode('base64')
-            # return '<img src="data:image/png;base64,{}">'.format(urllib.parse.quote(data.rstrip('\n')))
+    def create_shap_block(self, substation, day, top_k: int = SHAP_TOP_K) -> Optional[dict]:
+        # объяснения за день и за каждый его час разом: час по слайдеру браузер выбирает сам, без запроса
+        day = pd.to_datetime(day).normalize()
+        daily = self.create_shap(substation, day, None, top_k)
+        if daily is None:
+            return None
+        return {'hourly': [self.create_shap(substation, day, hour, top_k) for hour in range(24)], 'daily': daily}
 
-            return 'nope'
+    def _compute_day_explanation(self, substation: str, day: pd.Timestamp, top_k: int) -> Optional[dict]:
+        # день = сумма часов: вклады и базовые значения складываются, фичи упорядочены по среднему |вкладу|
+        # за час, значения фич - средние за день (для флагов - доля часов)
+        if len(self._day_rows(day)) == 0:
+            return None
+        rows, day_shap = self.get_shap(substation, day)
+        shap_vs = day_shap.decode().astype(np.float64)
+        contributions = shap_vs[:, :-1].sum(axis=0)
+        impact = np.abs(shap_vs[:, :-1]).mean(axis=0)
+        top = np.argsort(-impact, kind='stable')[:top_k]
+        values = self.features.iloc[rows, top].to_numpy(dtype=np.float64).mean(axis=0)
+        explanation = self._explanation(substation, f'{day:%Y-%m-%d}', shap_vs.sum(axis=0), contributions, top,
+                                        values.tolist())
+        explanation['impact'] = impact[top].tolist()
+        return explanation
 
+    def _explanation(self, substation: str, label: str, shap_row: np.ndarray, contributions: np.ndarray,
+                     top: np.ndarray, values: list) -> dict:
+        return {
+            'substation': substation,
+            'date_time': label,
+            'base_value': float(shap_row[-1]),
+            'prediction': float(shap_row.sum()),
+            'features': self.features.columns[top].tolist(),
+            'values': values,
+            'contributions': contributions[top].tolist(),
+            'other': float(contributions.sum() - contributions[top].sum()),
+        }
@@ -0,0 +1,184 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+STATES = ['queued', 'running', 'done', 'failed']
+JOB_FILE = 'job.json'
+LOG_TAIL = 2000  # сколько последних символов вывода parse_data.py сохранять в задаче
+PREVIOUS_SUFFIX = '.previous'
+
+
+def _write_json(path: Path, data: Dict[str, Any]):
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def ingested_hashes(manifest_path: Optional[Path]) -> Set[str]:
+    # sha1 уже разобранных журналов из manifest.json parse_data.py
+    if manifest_path is None or not manifest_path.is_file():
+        return set()
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    files = manifest.get('files', manifest)
+    return {entry['sha1'] for entry in files.values()}
+
+
+# очередь загруженных журналов на диске: spool/<состояние>/<id задачи>/ с файлами и job.json.
+# задача переходит между состояниями переименованием папки, так что ее нельзя взять дважды,
+# а статус читается любым воркером gunicorn без общей памяти.
+# журналы, которые уже разобраны (по manifest_path) или уже стоят в очереди, повторно не берем: сравниваем по sha1,
+# чтобы тот же файл под другим именем не разбирался второй раз и не гонял разбор впустую
+class IngestQueue:
+    def __init__(self, spool_dir: str, manifest_path: Optional[str] = None):
+        self.spool_dir = Path(spool_dir)
+        self.manifest_path = Path(manifest_path) if manifest_path is not None else None
+        self.logger = logging.getLogger()
+        for state in STATES + ['tmp']:
+            (self.spool_dir / state).mkdir(parents=True, exist_ok=True)
+
+    def pending_hashes(self) -> Set[str]:
+        hashes = set()
+        for state in ('queued', 'running'):
+            for job_dir in (self.spool_dir / state).iterdir():
+                job = self.status(job_dir.name)
+                if job is not None:
+                    hashes.update(job.get('sha1', {}).values())
+        return hashes
+
+    def submit(self, files: List[Tuple[str, bytes]]) -> str:
+        # id начинается со времени, чтобы задачи брались в порядке поступления
+        job_id = f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        job_dir = self.spool_dir / 'tmp' / job_id
+        job_dir.mkdir()
+        known = ingested_hashes(self.manifest_path) | self.pending_hashes()
+        names, hashes, skipped = [], {}, []
+        for name, content in files:
+            name = os.path.basename(name)
+            sha1 = hashlib.sha1(content).hexdigest()
+            if sha1 in known:
+                skipped.append(name)
+                continue
+            known.add(sha1)
+            with open(job_dir / name, 'wb') as f:
+                f.write(content)
+            names.append(name)
+            hashes[name] = sha1
+        job = {'id': job_id, 'files': names, 'sha1': hashes, 'skipped': skipped, 'submitted': time.time()}
+        if not names:
+            # разбирать нечего - задача сразу готова, интерфейс покажет, что журналы уже загружены
+            _write_json(job_dir / JOB_FILE, dict(job, finished=time.time()))
+            os.rename(job_dir, self.spool_dir / 'done' / job_id)
+            self.logger.info(f'Upload job {job_id}: all files are already ingested: {skipped}')
+            return job_id
+        _write_json(job_dir / JOB_FILE, job)
+        os.rename(job_dir, self.spool_dir / 'queued' / job_id)
+        self.logger.info(f'Upload job {job_id} is queued: {names}, already ingested: {skipped}')
+        return job_id
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job_id = os.path.basename(job_id)
+        for state in STATES:
+            job_path = self.spool_dir / state / job_id / JOB_FILE
+            try:
+                with open(job_path, 'r') as f:
+                    job = json.load(f)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            job['state'] = state
+            return job
+        return None
+
+    def claim(self) -> Optional[Path]:
+        for job_dir in sorted((self.spool_dir / 'queued').iterdir()):
+            running_dir = self.spool_dir / 'running' / job_dir.name
+            try:
+                os.rename(job_dir, running_dir)
+            except OSError:
+                # задачу уже забрал другой обработчик
+                continue
+            return running_dir
+        return None
+
+    def finish(self, job_dir: Path, ok: bool, **info):
+        job_path = job_dir / JOB_FILE
+        with open(job_path, 'r') as f:
+            job = json.load(f)
+        job.update(info, finished=time.time())
+        _write_json(job_path, job)
+        os.rename(job_dir, self.spool_dir / ('done' if ok else 'failed') / job_dir.name)
+
+
+def run_job(queue: IngestQueue, job_dir: Path, data_dir: Path, repo_root: Path, parse_args: List[str]):
+    # журналы кладем в data/uploads/<имя файла> и запускаем parse_data.py --incremental: новые файлы
+    # разберутся, а исправленный журнал с тем же именем заменит в датасете свою прошлую версию
+    with open(job_dir / JOB_FILE, 'r') as f:
+        job = json.load(f)
+    target_dir = data_dir / 'uploads'
+    target_dir.mkdir(parents=True, exist_ok=True)
+    for name in job['files']:
+        if (target_dir / name).is_file():
+            # прошлая версия - чтобы вернуть ее, если разбор не удастся
+            shutil.copy2(target_dir / name, job_dir / (name + PREVIOUS_SUFFIX))
+        # copy, а не copy2: время изменения - сейчас, чтобы manifest точно увидел новую версию
+        shutil.copy(job_dir / name, target_dir / name)
+
+    cmd = [sys.executable, str(repo_root / 'parse_data.py'), '--incremental', '--data-dir', str(data_dir)] + parse_args
+    queue.logger.info(f'Running job {job["id"]}: {" ".join(cmd)}')
+    started = time.time()
+    result = subprocess.run(cmd, cwd=repo_root, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    ok = result.returncode == 0
+    for name in job['files']:
+        previous = job_dir / (name + PREVIOUS_SUFFIX)
+        if not ok:
+            if previous.is_file():
+                os.replace(previous, target_dir / name)
+            else:
+                (target_dir / name).unlink(missing_ok=True)
+        previous.unlink(missing_ok=True)
+        (job_dir / name).unlink(missing_ok=True)
+    queue.finish(job_dir, ok, started=started, returncode=result.returncode, log=result.stdout[-LOG_TAIL:])
+    queue.logger.info(f'Job {job["id"]} is {"done" if ok else "failed"}')
+
+
+def work(queue: IngestQueue, data_dir: Path, repo_root: Path, parse_args: List[str], poll_interval: float):
+    # задачи, прерванные вместе с прошлым обработчиком, возвращаем в очередь
+    for job_dir in (queue.spool_dir / 'running').iterdir():
+        os.rename(job_dir, queue.spool_dir / 'queued' / job_dir.name)
+    while True:
+        job_dir = queue.claim()
+        if job_dir is None:
+            time.sleep(poll_interval)
+            continue
+        try:
+            run_job(queue, job_dir, data_dir, repo_root, parse_args)
+        except Exception as e:
+            queue.logger.exception(f'Job {job_dir.name} failed')
+            queue.finish(job_dir, False, log=str(e))
+
+
+def parse_args(argv: List[str]) -> Tuple[argparse.Namespace, List[str]]:
+    parser = argparse.ArgumentParser(description='Фоновый разбор загруженных журналов вызовов. '
+                                                 'Неизвестные аргументы передаются в parse_data.py')
+    parser.add_argument('--spool', type=Path, default=Path('../spool'))
+    parser.add_argument('--data-dir', type=Path, default=Path('../data'))
+    parser.add_argument('--repo-root', type=Path, default=Path('..'), help='где лежит parse_data.py')
+    parser.add_argument('--poll-interval', type=float, default=2.0)
+    return parser.parse_known_args(argv)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args, rest = parse_args(sys.argv[1:])
+    # parse_data.py запускается из корня репозитория, так что пути приводим к абсолютным
+    work(IngestQueue(str(args.spool)), args.data_dir.resolve(), args.repo_root.resolve(), rest, args.poll_interval)
@@ -1,7 +1,14 @@
 import catboost
+import hashlib
+import json
+import logging
 import os
 import pickle
+import struct
+import tempfile
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Union
 
 import numpy as np
 import pandas as pd
@@ -29,52 +36,314 @@ def get_funcs():
     return res, names
 
 
+FUNC_COLUMNS = ['hour', 'day', 'month']
+
+
+def _func_values(x: np.ndarray):
+    # все лямбды из get_funcs замыкают один и тот же i, который к моменту вызова равен 5.
+    # модели обучены именно на таких фичах, так что из 30 функций различаются только эти 6
+    i = 5
+    return [np.sin(i * x), np.cos(i * x), np.tanh(i * x), np.sin(x / i), np.cos(x / i), np.tanh(x / i)]
+
+
 def make_features(df):
-    df['date'] = pd.to_datetime(df['date'])
-    df['hour'] = df['date'].dt.hour
-    df['day'] = df['date'].dt.day
-    df['month'] = df['date'].dt.month
-    df['day_of_week'] = df['date'].dt.dayofweek
-    df['is_morning'] = (df['hour'] >= 4) & (df['hour'] <= 12)
-    df['is_day'] = (df['hour'] >= 13) & (df['hour'] <= 18)
-    df['is_evening'] = df['hour'] >= 19
-    df['is_night'] = df['hour'] < 4
-    df['full_hours'] = ((df['date'].dt.year - 2015) * 365 + df['month'] * 30 + df['day']) * 24 + df['hour']
-    funcs, nms = get_funcs()
-    for i, func in enumerate(funcs):
-        for col in ['hour', 'day', 'month']:
-            df[f"{nms[i]}_func_{col}"] = func(df[col])
-    return df.drop(columns=['date'])
-
-
-def make_predictions(df: pd.DataFrame, model_dir: str):
+    date = pd.to_datetime(df['date'])
+    base = pd.DataFrame(index=df.index)
+    base['hour'] = date.dt.hour
+    base['day'] = date.dt.day
+    base['month'] = date.dt.month
+    base['day_of_week'] = date.dt.dayofweek
+    base['is_morning'] = (base['hour'] >= 4) & (base['hour'] <= 12)
+    base['is_day'] = (base['hour'] >= 13) & (base['hour'] <= 18)
+    base['is_evening'] = base['hour'] >= 19
+    base['is_night'] = base['hour'] < 4
+    base['full_hours'] = ((date.dt.year - 2015) * 365 + base['month'] * 30 + base['day']) * 24 + base['hour']
+
+    # все тригонометрические фичи одним блоком; F-порядок, чтобы DataFrame взял массив без копирования
+    _, nms = get_funcs()
+    values = [_func_values(base[col].to_numpy()) for col in FUNC_COLUMNS]
+    funcs = np.empty((len(df), len(nms) * len(FUNC_COLUMNS)), dtype=np.float64, order='F')
+    names = []
+    for i, name in enumerate(nms):
+        for j, col in enumerate(FUNC_COLUMNS):
+            funcs[:, i * len(FUNC_COLUMNS) + j] = values[j][i % 6]
+            names.append(f"{name}_func_{col}")
+    funcs = pd.DataFrame(funcs, columns=names, index=df.index)
+
+    rest = df.drop(columns=['date'] + [col for col in [*base.columns, *names] if col in df.columns])
+    return pd.concat([rest, base, funcs], axis=1)
+
+
+CAT_FEATURES = ['hour', 'day', 'month', 'day_of_week']
+# серверный вид моделей подстанции (см. export_models.py): слитый ансамбль и коэффициенты поправок
+SERVING_MODEL = 'model.cbm'
+SERVING_CORRECTIONS = 'corrections.json'
+# или все подстанции одним файлом: [magic][uint32 версия][uint64 длина manifest][manifest json]
+# [коэффициенты trend/shrink: float64, (подстанции, 2, фичи + 1)][cbm-модели подряд]
+BUNDLE_NAME = 'models.bundle'
+BUNDLE_MAGIC = b'CBBUNDLE'
+BUNDLE_VERSION = 1
+_BUNDLE_HEADER = struct.Struct('<8sIQ')
+
+
+def _unpickle(path: str):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _pickle_files(target_dir: str) -> List[str]:
+    return sorted(pth for pth in os.listdir(target_dir) if pth.endswith('.pkl'))
+
+
+def source_hash(target_dir: str) -> Optional[str]:
+    # sha1 исходных pickle подстанции: экспорт его запоминает, чтобы потом заметить, что модели переобучили
+    files = _pickle_files(target_dir)
+    if not files:
+        return None
+    sha = hashlib.sha1()
+    for pth in files:
+        sha.update(pth.encode('utf-8'))
+        with open(os.path.join(target_dir, pth), 'rb') as f:
+            for buf in iter(lambda: f.read(1 << 20), b''):
+                sha.update(buf)
+    return sha.hexdigest()
+
+
+def source_stat(target_dir: str) -> Optional[str]:
+    # то же по именам, размерам и mtime pickle - без чтения содержимого; в снапшот модели копируются
+    # с сохранением mtime (или жесткими ссылками), так что подпись там та же, что при экспорте
+    files = _pickle_files(target_dir)
+    if not files:
+        return None
+    sha = hashlib.sha1()
+    for pth in files:
+        stat = os.stat(os.path.join(target_dir, pth))
+        sha.update(f'{pth}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _source_matches(target_models: 'SubstationModels', target_dir: str, stat: str) -> bool:
+    # содержимое читаем, только если подпись по stat разошлась (например, папку скопировали без mtime)
+    return target_models.source_stat == stat or target_models.source == source_hash(target_dir)
+
+
+class LinearCorrection:
+    # x @ coef + intercept - то же, что LinearRegression.predict, но без sklearn и pickle
+    def __init__(self, coef, intercept):
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+
+    @classmethod
+    def from_regression(cls, regression) -> 'LinearCorrection':
+        return cls(regression.coef_, regression.intercept_)
+
+    def predict(self, x: pd.DataFrame) -> np.ndarray:
+        return np.asarray(x, dtype=np.float64) @ self.coef + self.intercept
+
+    def to_json(self) -> dict:
+        return {'coef': self.coef.tolist(), 'intercept': self.intercept}
+
+
+class SubstationModels:
+    models: List[catboost.CatBoost]
+    source: Optional[str]  # source_hash pickle, из которых получены модели
+    source_stat: Optional[str]  # source_stat тех же pickle
+
+    def __init__(self, models, trend, shrink, source: Optional[str] = None, source_stat: Optional[str] = None):
+        self.models = models
+        self.trend = trend
+        self.shrink = shrink
+        self.source = source
+        self.source_stat = source_stat
+
+    def corrections(self, features: pd.DataFrame):
+        full_hours = features[['full_hours']]
+        return self.shrink.predict(full_hours), self.trend.predict(full_hours)
+
+    def fused(self) -> 'SubstationModels':
+        # среднее ансамбля - одна модель с листьями, умноженными на 1/n: один проход по деревьям и один SHAP
+        # вместо n (SHAP линеен по модели, так что совпадает с точностью до float)
+        model = catboost.sum_models(self.models, weights=[1 / len(self.models)] * len(self.models))
+        return SubstationModels([model], LinearCorrection.from_regression(self.trend),
+                                LinearCorrection.from_regression(self.shrink), self.source, self.source_stat)
+
+    def save(self, target_dir: str):
+        if len(self.models) != 1 or not isinstance(self.trend, LinearCorrection):
+            raise ValueError('Only fused models can be saved, call fused() first')
+        os.makedirs(target_dir, exist_ok=True)
+        self.models[0].save_model(os.path.join(target_dir, SERVING_MODEL + '.tmp'), format='cbm')
+        os.replace(os.path.join(target_dir, SERVING_MODEL + '.tmp'), os.path.join(target_dir, SERVING_MODEL))
+        with open(os.path.join(target_dir, SERVING_CORRECTIONS), 'w') as f:
+            json.dump({'trend': self.trend.to_json(), 'shrink': self.shrink.to_json(), 'source_sha1': self.source,
+                       'source_stat': self.source_stat}, f, indent=1)
+
+
+class ModelRegistry:
+    targets: Dict[str, SubstationModels]
+
+    def __init__(self, model_dir: str, serving: bool = True):
+        # serving=False - всегда исходные ансамбли из pickle, даже если рядом лежит экспорт.
+        # экспорт берется, только если он сделан из тех pickle, что лежат сейчас (или pickle нет вовсе):
+        # иначе модели переобучили, а export_models.py не перезапустили - тогда работаем на pickle
+        self.model_dir = model_dir
+        self.logger = logging.getLogger()
+        # порядок подстанций - по имени: от него зависит порядок столбцов прогноза, а os.listdir
+        # у скопированной в снапшот папки может вернуть их в любом порядке
+        target_dirs = {target: os.path.join(model_dir, target) for target in sorted(os.listdir(model_dir))
+                       if os.path.isdir(os.path.join(model_dir, target))}
+        if serving and os.path.isfile(os.path.join(model_dir, BUNDLE_NAME)):
+            targets = load_bundle(os.path.join(model_dir, BUNDLE_NAME))
+            stats = {target: source_stat(path) for target, path in target_dirs.items()}
+            stats = {target: stat for target, stat in stats.items() if stat is not None}
+            if not stats or (stats.keys() == targets.keys() and
+                             all(_source_matches(targets[target], target_dirs[target], stat)
+                                 for target, stat in stats.items())):
+                self.targets = dict(sorted(targets.items()))
+                return
+            self.logger.warning(f'{BUNDLE_NAME} is stale (pickles were changed after export), '
+                                f'loading models from pickles; re-run export_models.py')
+        self.targets = {target: self._load_target(target_dir, serving) for target, target_dir in target_dirs.items()}
+
+    def _load_target(self, target_dir: str, serving: bool = True) -> SubstationModels:
+        files = os.listdir(target_dir)
+        stat = source_stat(target_dir)
+        if serving and SERVING_MODEL in files and SERVING_CORRECTIONS in files:
+            target_models = ModelRegistry._load_serving(target_dir)
+            if stat is None or _source_matches(target_models, target_dir, stat):
+                return target_models
+            self.logger.warning(f'{target_dir}: {SERVING_MODEL} is stale, loading models from pickles; '
+                                f're-run export_models.py')
+        model_files = [pth for pth in files if pth.endswith('.pkl') and 'shrink' not in pth and 'trend' not in pth]
+        trend_files = [pth for pth in files if 'trend' in pth]
+        shrink_files = [pth for pth in files if 'shrink' in pth]
+        if not model_files or len(trend_files) != 1 or len(shrink_files) != 1:
+            raise ValueError(f'{target_dir}: expected model_*.pkl, one trend and one shrink model, got {files}')
+
+        models = [_unpickle(os.path.join(target_dir, pth)) for pth in model_files]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            trend = _unpickle(os.path.join(target_dir, trend_files[0]))
+            shrink = _unpickle(os.path.join(target_dir, shrink_files[0]))
+        return SubstationModels(models, trend, shrink, source_hash(target_dir), stat)
+
+    @staticmethod
+    def _load_serving(target_dir: str) -> SubstationModels:
+        model = catboost.CatBoost()
+        model.load_model(os.path.join(target_dir, SERVING_MODEL), format='cbm')
+        with open(os.path.join(target_dir, SERVING_CORRECTIONS), 'r') as f:
+            corrections = json.load(f)
+        return SubstationModels([model], LinearCorrection(**corrections['trend']),
+                                LinearCorrection(**corrections['shrink']), corrections.get('source_sha1'),
+                                corrections.get('source_stat'))
+
+    @staticmethod
+    def make_pool(features: pd.DataFrame) -> catboost.Pool:
+        return catboost.Pool(features, cat_features=CAT_FEATURES)
+
+
+def _model_bytes(model: catboost.CatBoost) -> bytes:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, SERVING_MODEL)
+        model.save_model(path, format='cbm')
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+def save_bundle(targets: Dict[str, SubstationModels], path: str):
+    blobs, slots, coefficients = [], [], []
+    offset = 0
+    for slot, (name, target_models) in enumerate(targets.items()):
+        if len(target_models.models) != 1 or not isinstance(target_models.trend, LinearCorrection):
+            raise ValueError(f'{name}: only fused models can be bundled, call fused() first')
+        blobs.append(_model_bytes(target_models.models[0]))
+        slots.append({'name': name, 'slot': slot, 'offset': offset, 'size': len(blobs[-1]),
+                      'source_sha1': target_models.source, 'source_stat': target_models.source_stat})
+        offset += len(blobs[-1])
+        coefficients.append([np.r_[c.coef, c.intercept] for c in (target_models.trend, target_models.shrink)])
+    coefficients = np.asarray(coefficients, dtype='<f8')
+    manifest = json.dumps({'targets': slots, 'coefficients_shape': list(coefficients.shape)},
+                          ensure_ascii=False).encode('utf-8')
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(manifest)))
+        f.write(manifest)
+        f.write(coefficients.tobytes())
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+
+def load_bundle(path: str) -> Dict[str, SubstationModels]:
+    # одно последовательное чтение файла, дальше - срезы из памяти; pickle не участвует
+    with open(path, 'rb') as f:
+        data = memoryview(f.read())
+    magic, version, manifest_size = _BUNDLE_HEADER.unpack_from(data)
+    if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+        raise ValueError(f'{path}: not a model bundle of version {BUNDLE_VERSION}')
+    start = _BUNDLE_HEADER.size
+    manifest = json.loads(bytes(data[start:start + manifest_size]).decode('utf-8'))
+    start += manifest_size
+    shape = manifest['coefficients_shape']
+    coefficients = np.frombuffer(data, dtype='<f8', count=int(np.prod(shape)), offset=start).reshape(shape)
+    start += coefficients.nbytes
+
+    targets = {}
+    for entry in manifest['targets']:
+        model = catboost.CatBoost()
+        blob_start = start + entry['offset']
+        model.load_model(blob=bytes(data[blob_start:blob_start + entry['size']]))
+        trend, shrink = coefficients[entry['slot']]
+        targets[entry['name']] = SubstationModels([model], LinearCorrection(trend[:-1], trend[-1]),
+                                                  LinearCorrection(shrink[:-1], shrink[-1]), entry.get('source_sha1'),
+                                                  entry.get('source_stat'))
+    return targets
+
+
+def _shap_values(target_models: SubstationModels, pool: catboost.Pool, shrink: np.ndarray, trend: np.ndarray,
+                 thread_count: int = -1) -> np.ndarray:
+    imps = np.mean([model.get_feature_importance(pool, type='ShapValues', thread_count=thread_count)
+                    for model in target_models.models], axis=0)
+    imps[:, -1] = imps[:, -1] * shrink + trend
+    imps[:, :-1] = np.transpose(np.transpose(imps[:, :-1], (1, 0)) * shrink, (1, 0))
+    return imps
+
+
+def make_shap_values(target_models: SubstationModels, features: pd.DataFrame, thread_count: int = -1) -> np.ndarray:
+    # SHAP только для переданных строк фичей (например, одного дня)
+    shrink, trend = target_models.corrections(features)
+    return _shap_values(target_models, ModelRegistry.make_pool(features), shrink, trend, thread_count)
+
+
+def predict_target(target_models: SubstationModels, pool: catboost.Pool, features: pd.DataFrame,
+                   thread_count: int = -1, with_shap: bool = True):
+    shrink, trend = target_models.corrections(features)
+    models = target_models.models
+
+    preds = np.mean([model.predict(pool, thread_count=thread_count) for model in models], axis=0) * shrink + trend
+    preds = np.round(preds+0.1)
+    preds[preds < 0] = 0
+
+    imps = _shap_values(target_models, pool, shrink, trend, thread_count) if with_shap else None
+    return preds, imps
+
+
+def make_predictions(df: pd.DataFrame, registry: Union[str, ModelRegistry], workers: int = 1,
+                     with_shap: bool = True, thread_count: Optional[int] = None):
+    if isinstance(registry, str):
+        registry = ModelRegistry(registry)
     res = dict()
     res['date_time'] = df['date']
-    targets = os.listdir(model_dir)
     good_df = make_features(df)
+    pool = registry.make_pool(good_df)
     shaps = {}
-    for target in tqdm(targets):
-        pool = catboost.Pool(good_df, cat_features=['hour', 'day', 'month', 'day_of_week'])
-        models = [pickle.load(open(f"{model_dir}/{target}/{pth}", 'rb')) for pth in os.listdir(f"{model_dir}/{target}/")
-                  if 'shrink' not in pth and 'trend' not in pth]
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            trend = \
-            [pickle.load(open(f"{model_dir}/{target}/{pth}", 'rb')) for pth in os.listdir(f"{model_dir}/{target}/") if
-             'trend' in pth][0]
-            shrink = \
-            [pickle.load(open(f"{model_dir}/{target}/{pth}", 'rb')) for pth in os.listdir(f"{model_dir}/{target}/") if
-             'shrink' in pth][0]
-
-        preds = np.mean([model.predict(pool) for model in models], axis=0) * shrink.predict(
-            good_df[['full_hours']]) + trend.predict(good_df[['full_hours']])
-        preds = np.round(preds+0.1)
-        preds[preds < 0] = 0
-        res[target] = preds
-
-        imps = np.mean([model.get_feature_importance(pool, type='ShapValues') for model in models], axis=0)
-        imps[:, -1] = imps[:, -1] * shrink.predict(good_df[['full_hours']]) + trend.predict(good_df[['full_hours']])
-        imps[:, :-1] = np.transpose(np.transpose(imps[:, :-1], (1, 0)) * shrink.predict(good_df[['full_hours']]),
-                                    (1, 0))
-        shaps[target] = imps
-    return pd.DataFrame(res), shaps, good_df
\ No newline at end of file
+    # catboost отпускает GIL, так что хватает потоков; при нескольких воркерах каждый
+    # считает в один поток, чтобы не было переподписки ядер
+    if thread_count is None:
+        thread_count = -1 if workers == 1 else 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {target: executor.submit(predict_target, target_models, pool, good_df, thread_count, with_shap)
+                   for target, target_models in registry.targets.items()}
+        for target, future in tqdm(futures.items()):
+            res[target], shaps[target] = future.result()
+    return pd.DataFrame(res), (shaps if with_shap else None), good_df
@@ -0,0 +1,88 @@
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+LEVELS = ['hour', 'day', 'week', 'month']
+
+
+class Rollup:
+    # один уровень пирамиды: calls[период, подстанция], суммы по всем подстанциям,
+    # starts - с какой строки более мелкого уровня начинается каждый период,
+    # order - подстанции по возрастанию средней загрузки на этом уровне (порядок столбиков в графиках)
+    index: pd.DatetimeIndex
+    calls: np.ndarray
+    total: np.ndarray
+    starts: np.ndarray
+    order: np.ndarray
+
+    def __init__(self, index: pd.DatetimeIndex, calls: np.ndarray, starts: np.ndarray, order: np.ndarray,
+                 total: Optional[np.ndarray] = None):
+        self.index = index
+        self.calls = calls
+        self.starts = starts
+        self.order = order
+        self.total = calls.sum(axis=1, dtype=_sum_dtype(calls)) if total is None else total
+
+    def row(self, date_time) -> Optional[int]:
+        try:
+            return self.index.get_loc(pd.Timestamp(date_time))
+        except KeyError:
+            return None
+
+    def finer_rows(self, i: int, finer: 'Rollup') -> np.ndarray:
+        end = self.starts[i + 1] if i + 1 < len(self.starts) else len(finer.index)
+        return np.arange(self.starts[i], end)
+
+
+def _sum_dtype(calls: np.ndarray) -> np.dtype:
+    # суммы целых вызовов - в uint32 (за месяц uint16 уже мало), float остается float
+    return np.promote_types(calls.dtype, np.uint32)
+
+
+def compact_calls(calls: np.ndarray) -> np.ndarray:
+    # прогноз - целое неотрицательное число вызовов (predict_target округляет), так что хватает uint16
+    if calls.size and (calls.min() < 0 or calls.max() > np.iinfo(np.uint16).max
+                       or not np.array_equal(calls, np.round(calls))):
+        return calls
+    return calls.astype(np.uint16)
+
+
+def _order(calls: np.ndarray, names: np.ndarray) -> np.ndarray:
+    by_name = np.argsort(names, kind='stable')
+    return by_name[np.argsort(calls.mean(axis=0)[by_name], kind='stable')]
+
+
+def _roll_up(finer: Rollup, keys: pd.DatetimeIndex, names: np.ndarray) -> Rollup:
+    # строки отсортированы по времени, так что каждый период - непрерывный отрезок
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    calls = np.add.reduceat(finer.calls, starts, axis=0, dtype=_sum_dtype(finer.calls))
+    return Rollup(keys[starts], calls, starts, _order(calls, names))
+
+
+def build_rollups(times: pd.DatetimeIndex, calls: np.ndarray, names: np.ndarray) -> Dict[str, Rollup]:
+    hour = Rollup(pd.DatetimeIndex(times), calls, np.arange(len(times)), _order(calls, names))
+    day = _roll_up(hour, hour.index.normalize(), names)
+    week = _roll_up(day, day.index - pd.to_timedelta(day.index.dayofweek, unit='d'), names)
+    month = _roll_up(day, day.index.to_period('M').to_timestamp(), names)
+    return {'hour': hour, 'day': day, 'week': week, 'month': month}
+
+
+def rollups_to_arrays(rollups: Dict[str, Rollup]) -> Dict[str, np.ndarray]:
+    arrays = {}
+    for level, rollup in rollups.items():
+        arrays[f'rollup/{level}/index'] = rollup.index.to_numpy()
+        arrays[f'rollup/{level}/calls'] = rollup.calls
+        arrays[f'rollup/{level}/total'] = rollup.total
+        arrays[f'rollup/{level}/starts'] = rollup.starts
+        arrays[f'rollup/{level}/order'] = rollup.order
+    return arrays
+
+
+def rollups_from_arrays(arrays: Dict[str, np.ndarray]) -> Dict[str, Rollup]:
+    return {level: Rollup(pd.DatetimeIndex(arrays[f'rollup/{level}/index']),
+                          arrays[f'rollup/{level}/calls'],
+                          arrays[f'rollup/{level}/starts'],
+                          arrays[f'rollup/{level}/order'],
+                          arrays[f'rollup/{level}/total'])
+            for level in LEVELS}
@@ -0,0 +1,87 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+QUANT_MAX = np.iinfo(np.int16).max
+
+
+def _scale_for(values: np.ndarray) -> np.ndarray:
+    # шаг квантования по столбцу: максимум |значения| ложится на 32767; у нулевых столбцов - 1
+    scale = np.abs(values).max(axis=0).astype(np.float32) / QUANT_MAX if len(values) else \
+        np.ones(values.shape[1], dtype=np.float32)
+    scale[scale == 0] = 1
+    return scale
+
+
+def _quantize(values: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    return np.clip(np.round(values / scale), -QUANT_MAX, QUANT_MAX).astype(np.int16)
+
+
+def top_contributions(values: np.ndarray, k: int) -> np.ndarray:
+    # индексы k самых сильных вкладов в строке (по |SHAP|, без последнего столбца - базового значения)
+    contributions = np.abs(values[:, :-1])
+    return np.argsort(-contributions, axis=1, kind='stable')[:, :k].astype(np.int16)
+
+
+class QuantizedShap:
+    # SHAP [часы, фичи + 1] в int16 с масштабом на столбец (в 4 раза меньше float64) и заранее посчитанные
+    # по точным значениям top[час] - индексы самых сильных вкладов, только они и показываются
+    values: np.ndarray
+    scale: np.ndarray
+    top: np.ndarray
+
+    def __init__(self, values: np.ndarray, scale: np.ndarray, top: np.ndarray):
+        self.values = values
+        self.scale = scale
+        self.top = top
+
+    @classmethod
+    def from_values(cls, values: np.ndarray, top_k: int, scale: Optional[np.ndarray] = None) -> 'QuantizedShap':
+        scale = _scale_for(values) if scale is None else scale
+        return cls(_quantize(values, scale), scale, top_contributions(values, top_k))
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def take(self, rows) -> 'QuantizedShap':
+        return QuantizedShap(self.values[rows], self.scale, self.top[rows])
+
+    def decode(self, rows=slice(None)) -> np.ndarray:
+        return self.values[rows] * self.scale
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        return {f'{prefix}/values': self.values, f'{prefix}/scale': self.scale, f'{prefix}/top': self.top}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], prefix: str) -> 'QuantizedShap':
+        return cls(arrays[f'{prefix}/values'], arrays[f'{prefix}/scale'], arrays[f'{prefix}/top'])
+
+
+def merge_shap(base: Optional[QuantizedShap], base_rows: np.ndarray, new_values: Optional[np.ndarray],
+               top_k: int) -> QuantizedShap:
+    # строки base_rows >= 0 берутся из base, остальные - из new_values (по порядку).
+    # масштаб base сохраняется, пока в него влезают новые значения, так что переиспользованные строки
+    # копируются как есть; если столбцу нужен больший шаг - только он переквантовывается
+    known = base_rows >= 0
+    scale = base.scale.copy() if base is not None else None
+    if new_values is not None and len(new_values):
+        new_scale = _scale_for(new_values)
+        scale = new_scale if scale is None else np.maximum(scale, new_scale)
+    if scale is None:
+        scale = base.scale
+
+    width = (base.values if base is not None else new_values).shape[1]
+    values = np.empty((len(base_rows), width), dtype=np.int16)
+    top = np.empty((len(base_rows), min(top_k, width - 1)), dtype=np.int16)
+    if known.any():
+        old = base.values[base_rows[known]]
+        changed = scale != base.scale
+        if changed.any():
+            old = old.copy()
+            old[:, changed] = _quantize(old[:, changed] * base.scale[changed], scale[changed])
+        values[known] = old
+        top[known] = base.top[base_rows[known]]
+    if new_values is not None:
+        values[~known] = _quantize(new_values, scale)
+        top[~known] = top_contributions(new_values, top_k)
+    return QuantizedShap(values, scale, top)
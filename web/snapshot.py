@@ -0,0 +1,112 @@
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime as dt, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from cache_store import CacheStore
+from graph_factory import GraphFactory
+
+CACHE_PATH = '../cache'
+INFER_FROM, INFER_TO = dt(2022, 5, 25), dt(2023, 5, 25)  # диапазон прогноза, если ROLLING_HORIZON = None
+# скользящий горизонт: прогноз от (сейчас - RETENTION) до (сейчас + ROLLING_HORIZON), например timedelta(days=365).
+# сдвигать окно - python snapshot.py --every 3600: пересчитываются только новые часы
+ROLLING_HORIZON: Optional[timedelta] = None
+RETENTION = timedelta(days=30)
+
+
+def infer_range(now: Optional[dt] = None) -> Tuple[dt, dt]:
+    if ROLLING_HORIZON is None:
+        return INFER_FROM, INFER_TO
+    now = now or dt.now()
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    return (hour - RETENTION).replace(hour=0), hour + ROLLING_HORIZON
+
+
+def make_graph_factory() -> GraphFactory:
+    infer_from, infer_to = infer_range()
+    return GraphFactory('../fixed_substation.json', '../models', infer_from, infer_to, CACHE_PATH,
+                        workers=os.cpu_count())
+
+
+# действующий GraphFactory воркера. Раз в check_interval секунд (из before_request) смотрим, не опубликован ли
+# новый снапшот; если да - открываем его и грузим модели в фоновом потоке и только потом подменяем current.
+# Коллбэк берет current один раз в начале, так что запрос целиком отрабатывает на одном снапшоте
+class FactoryHolder:
+    current: GraphFactory
+
+    def __init__(self, make_factory: Callable[[], GraphFactory], check_interval: float = 5.0):
+        self.make_factory = make_factory
+        self.check_interval = check_interval
+        self.logger = logging.getLogger()
+        self.current = make_factory()
+        self.current.load()
+        self.current.get_registry()
+        self._store = CacheStore(self.current.cache_path)
+        self._published = self._store.current()
+        self._checked = time.monotonic()
+        self._lock = threading.Lock()
+        self._loading: Optional[threading.Thread] = None
+
+    def check(self):
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        with self._lock:
+            if now - self._checked < self.check_interval or self._loading is not None:
+                return
+            self._checked = now
+            published = self._store.current()
+            if published is None or published == self._published:
+                return
+            # поток стартует только в воркере: в мастере до форка check не вызывается
+            self._loading = threading.Thread(target=self._reload, args=(published,), daemon=True)
+            self._loading.start()
+
+    def _reload(self, published: str):
+        try:
+            factory = self.make_factory()
+            if factory.load_published():
+                # сдвинулось только окно - модели (общие с мастером) и кэш SHAP остаются прежними;
+                # новые модели каждый воркер грузит сам (массивы прогноза при этом общие - через mmap)
+                if not factory.adopt(self.current):
+                    factory.get_registry()
+                self.current = factory
+                self.logger.info(f'Switched to snapshot {published} (version {factory.version})')
+        except Exception:
+            self.logger.exception(f'Failed to load snapshot {published}')
+        finally:
+            # неудачный снапшот второй раз не пробуем - ждем следующей публикации
+            self._published = published
+            self._loading = None
+
+
+def publish() -> GraphFactory:
+    # load() сам решает, что делать: снапшот под текущие модели и окно уже есть - ничего,
+    # сдвинулось окно - досчитать новые часы, сменились модели - посчитать заново
+    graph_factory = make_graph_factory()
+    graph_factory.load()
+    return graph_factory
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Посчитать и опубликовать снапшот предсказаний для текущих моделей '
+                                                 'и диапазона дат. Запущенные воркеры переключатся на него сами')
+    parser.add_argument('--every', type=float, default=None,
+                        help='повторять раз в столько секунд (скользящий горизонт, новые модели)')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    # после замены моделей в ../models: посчитать и опубликовать снапшот, воркеры переключатся на него сами
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    args = parse_args(sys.argv[1:])
+    while True:
+        graph_factory = publish()
+        print(f': Published {graph_factory.snapshot_path} (version {graph_factory.version})')
+        if args.every is None:
+            break
+        time.sleep(args.every)
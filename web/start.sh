@@ -1,3 +1,8 @@
+# разбор загруженных журналов - отдельным процессом, чтобы не занимать воркеры gunicorn
+(while true; do python ingest_queue.py; sleep 1; done) &
+# раз в час публикуем снапшот предсказаний: сдвигает скользящий горизонт (snapshot.ROLLING_HORIZON) и подхватывает
+# новые модели из ../models - воркеры переключатся без перезапуска, цикл ниже только поднимает gunicorn после падения
+(while true; do sleep 3600; python snapshot.py --every 3600; done) &
 while true
 do
 gunicorn -c config.py app:server